@@ -1,50 +1,83 @@
 import os
 import logging
 import asyncio
+import importlib.util
+from dataclasses import dataclass, fields
 from datetime import datetime, timedelta, time, timezone
 from pathlib import Path
+from time import monotonic
 import pytz
-from typing import Set, Optional
+from typing import Any, Awaitable, Callable, Optional, Sequence, Set
 import re
+import html
+from collections import OrderedDict
+from contextlib import suppress
+import asyncpg
 import httpx
+import orjson
 
 # Simple validators
+_URL_RE = re.compile(r"(https?://)[\w\-]+(\.[\w\-]+)+(:\d+)?(/[\w\-._~:/?#\[\]@!$&'()*+,;=%]*)?")
+
+
 def is_valid_url(url: str) -> bool:
     if not url or not isinstance(url, str):
         return False
-    url = url.strip()
-    return bool(re.match(r"^(https?://)[\w\-]+(\.[\w\-]+)+(:\d+)?(/[\w\-._~:/?#\[\]@!$&'()*+,;=%]*)?$", url))
+    return bool(_URL_RE.fullmatch(url.strip()))
+
+# Telegram photo caption limit is 1024 chars for older APIs; use 1024 as a safe cap
+_CAP_MAX = 1024
+# Zero-width символы, которые часто прилетают при копировании текста.
+# U+200D (ZWJ) не трогаем: на нём держатся составные эмодзи.
+_ZW_TABLE = str.maketrans("", "", "\u200b\u200c\ufeff")
 
 def is_valid_caption(c: str) -> bool:
-    # Telegram photo caption limit is 1024 chars for older APIs; use 1024 as a safe cap
-    return c is not None and len(c) <= 1024
+    return isinstance(c, str) and len(c) <= _CAP_MAX
+
+def clean_caption(c: str) -> str:
+    return c.translate(_ZW_TABLE)
+
+# Спецсимволы MarkdownV2: экранируем их за один проход translate
+_MD2_SPECIAL = r"_*[]()~`>#+-=|{}.!"
+_MD2_TABLE = str.maketrans({c: "\\" + c for c in _MD2_SPECIAL})
+
+def escape_markdown_v2(text: str) -> str:
+    return text.translate(_MD2_TABLE)
 
 from dotenv import load_dotenv, dotenv_values, find_dotenv
 from telegram import (
     Update,
+    CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
+    Message,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
     BotCommand,
 )
-from telegram.constants import ChatMemberStatus
-from telegram.error import Forbidden
+from telegram.constants import ChatMemberStatus, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
+    AIORateLimiter,
     ApplicationBuilder,
     CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
-    PicklePersistence,
     ContextTypes,
     TypeHandler,
     filters,
 )
 from telegram.request import HTTPXRequest
-from db import create_pool, init_schema, upsert_user, set_vk_id, get_user, get_user_by_username, get_all_user_ids, load_user_vk_data, get_user_stats, export_users_to_excel
+from db import (
+    create_pool, init_schema, upsert_user, get_user, get_user_by_username, get_active_user_ids, load_user_vk_data, get_user_stats, export_users_to_excel,
+    get_posters, insert_poster, deactivate_poster, set_poster_ticket_url, UpsertQueue, VkIdListener, advance_missed_weeks,
+    set_user_active,
+)
+from pg_persistence import PostgresPersistence
 
 # ----------------------
 # Logging
@@ -78,17 +111,14 @@ def _get_env(key: str, default: str = "") -> str:
     return _clean_env(v)
 
 
-BOT_TOKEN = _get_env("BOT_TOKEN", "")
-ADMIN_USER_ID_STR = _get_env("ADMIN_USER_ID", "")
-ADMIN_USER_ID = int(ADMIN_USER_ID_STR) if ADMIN_USER_ID_STR.isdigit() else 0
-ADMIN_USER_ID_2_STR = _get_env("ADMIN_USER_ID_2", "")
-ADMIN_USER_ID_2 = int(ADMIN_USER_ID_2_STR) if ADMIN_USER_ID_2_STR.isdigit() else 0
-ADMIN_USER_ID_3_STR = _get_env("ADMIN_USER_ID_3", "")
-ADMIN_USER_ID_3 = int(ADMIN_USER_ID_3_STR) if ADMIN_USER_ID_3_STR.isdigit() else 0
-ADMIN_USER_ID_4_STR = _get_env("ADMIN_USER_ID_4", "")
-ADMIN_USER_ID_4 = int(ADMIN_USER_ID_4_STR) if ADMIN_USER_ID_4_STR.isdigit() else 0
-CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "@largentmsk")
-CHANNEL_USERNAME_2 = os.getenv("CHANNEL_USERNAME_2", "@idnrecords")
+def _get_admin_id(key: str) -> int:
+    v = _get_env(key, "")
+    return int(v) if v.isdigit() else 0
+
+
+_TME_PREFIX_RE = re.compile(r"^(?:https?://)?t\.me/", re.IGNORECASE)
+_VK_PREFIX_RE = re.compile(r"^(?:https?://)?vk\.com/", re.IGNORECASE)
+
 
 def _normalize_channel(value: str):
     v = (value or "").strip()
@@ -96,35 +126,66 @@ def _normalize_channel(value: str):
     if v.startswith("-100") and v[4:].isdigit():
         return int(v)
     # strip t.me prefixes
-    for prefix in ("https://t.me/", "http://t.me/", "t.me/"):
-        if v.lower().startswith(prefix):
-            v = v[len(prefix):]
-            break
+    v = _TME_PREFIX_RE.sub("", v, count=1)
     if not v.startswith("@"):
         v = f"@{v}"
     return v
 
-CHANNEL_ID = _normalize_channel(CHANNEL_USERNAME)
-CHANNEL_ID_2 = _normalize_channel(CHANNEL_USERNAME_2)
 WEEKLY_DAY = int(_get_env("WEEKLY_DAY", "4"))  # 0=Mon..6=Sun
 WEEKLY_HOUR_LOCAL = int(_get_env("WEEKLY_HOUR", "12"))
 WEEKLY_MINUTE = int(_get_env("WEEKLY_MINUTE", "0"))
-# VK integration
-VK_TOKEN = _get_env("VK_TOKEN", "")
-VK_ENABLED = bool(VK_TOKEN)
 def _normalize_vk_group_domain(v: str) -> str:
-    v = v.strip()
-    for prefix in ("https://vk.com/", "http://vk.com/", "vk.com/"):
-        if v.lower().startswith(prefix):
-            v = v[len(prefix):]
-            break
+    v = _VK_PREFIX_RE.sub("", v.strip(), count=1)
     return v.strip("/") or "largent.tusa"
-VK_GROUP_DOMAIN = os.getenv("VK_GROUP_DOMAIN", "largent.tusa")
-# Proxy settings
-PROXY_URL = _get_env("PROXY_URL", "")
 # Convert MSK (UTC+3) local hour to UTC for job queue
 WEEKLY_HOUR_UTC = (WEEKLY_HOUR_LOCAL - 3) % 24
 
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Настройки из окружения, вычисленные один раз при импорте"""
+    bot_token: str
+    # Основной админ: ему уходят служебные уведомления и отчёты
+    admin_id: int
+    admin_ids: frozenset[int]
+    channel_id: str | int
+    channel_id_2: str | int
+    vk_token: str
+    vk_group_domain: str
+    proxy_url: str
+    # PERSIST_STATE=0 - не сохранять состояние пользователей между перезапусками
+    persist_state: bool
+
+
+_ADMIN_ID = _get_admin_id("ADMIN_USER_ID")
+
+CONFIG = Config(
+    bot_token=_get_env("BOT_TOKEN", ""),
+    admin_id=_ADMIN_ID,
+    admin_ids=frozenset(
+        a for a in (
+            _ADMIN_ID,
+            _get_admin_id("ADMIN_USER_ID_2"),
+            _get_admin_id("ADMIN_USER_ID_3"),
+            _get_admin_id("ADMIN_USER_ID_4"),
+        ) if a
+    ),
+    channel_id=_normalize_channel(os.getenv("CHANNEL_USERNAME", "@largentmsk")),
+    channel_id_2=_normalize_channel(os.getenv("CHANNEL_USERNAME_2", "@idnrecords")),
+    vk_token=_get_env("VK_TOKEN", ""),
+    vk_group_domain=os.getenv("VK_GROUP_DOMAIN", "largent.tusa"),
+    proxy_url=_get_env("PROXY_URL", ""),
+    persist_state=_get_env("PERSIST_STATE", "1") != "0",
+)
+
+# VK integration
+VK_ENABLED = bool(CONFIG.vk_token)
+# Ссылки на каналы и группу для кнопок и статуса подписок
+TG1_URL = f"https://t.me/{str(CONFIG.channel_id).lstrip('@')}"
+TG2_URL = f"https://t.me/{str(CONFIG.channel_id_2).lstrip('@')}"
+VK_GROUP_URL = f"https://vk.com/{CONFIG.vk_group_domain}"
+
 logger.info("Loaded .env from: %s", _DOTENV_PATH)
 
 REENGAGE_TEXT = (
@@ -133,6 +194,11 @@ REENGAGE_TEXT = (
     "Возвращайся скорее, будем делать тыц тыц тыц как в старые добрые 💃🕺🏻"
 )
 
+# Сколько секунд данные пользователя из БД считаются свежими
+USER_DATA_TTL = 60
+# Сколько секунд держим статистику пользователей для админ-панели
+STATS_TTL = 30
+
 DATA_DIR = Path(__file__).parent / "data"
 PERSISTENCE_FILE = DATA_DIR / "bot_data.pkl"
 
@@ -154,78 +220,332 @@ def previous_week_key(now: datetime) -> str:
     return week_key_for_date(last_week_date)
 
 
+# Подтверждённые подписки: tg_id -> (момент проверки по monotonic(), результат).
+# Отрицательный результат не кешируем - пользователь подписывается и сразу
+# жмёт «проверить», ему нужен свежий ответ.
+SUBSCRIPTION_TTL = 30
+_SUBSCRIPTION_CACHE_SIZE = 4096
+_subscriptions: "OrderedDict[int, tuple[float, tuple[bool, bool]]]" = OrderedDict()
+# Проверки, которые уже идут: одновременные нажатия ждут один и тот же запрос
+_subscription_checks: dict[int, "asyncio.Future[tuple[bool, bool]]"] = {}
+
+
 async def is_user_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> tuple[bool, bool]:
     """Проверить подписку пользователя на оба Telegram канала
     
     Returns:
         tuple[bool, bool]: (подписан на первый канал, подписан на второй канал)
     """
-    channel1_ok = False
-    channel2_ok = False
-    
-    # Проверяем первый канал
-    try:
-        member = await context.bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        channel1_ok = member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logger.warning("Failed to check TG subscription for user %s on %s: %s", user_id, CHANNEL_USERNAME, e)
+    cached = _subscriptions.get(user_id)
+    if cached is not None:
+        if 0 <= monotonic() - cached[0] < SUBSCRIPTION_TTL:
+            return cached[1]
+        del _subscriptions[user_id]
+
+    check = _subscription_checks.get(user_id)
+    if check is None:
+        check = asyncio.ensure_future(_fetch_subscription(context.bot, user_id))
+        _subscription_checks[user_id] = check
+        check.add_done_callback(lambda _: _subscription_checks.pop(user_id, None))
+    # shield: отмена одного ожидающего не должна отменять запрос для остальных
+    result = await asyncio.shield(check)
+
+    if all(result):
+        _subscriptions[user_id] = (monotonic(), result)
+        if len(_subscriptions) > _SUBSCRIPTION_CACHE_SIZE:
+            _subscriptions.popitem(last=False)
+    return result
+
+
+async def _fetch_subscription(bot, user_id: int) -> tuple[bool, bool]:
+    # Оба запроса независимы - выполняем их параллельно
+    results = await asyncio.gather(
+        bot.get_chat_member(CONFIG.channel_id, user_id),
+        bot.get_chat_member(CONFIG.channel_id_2, user_id),
+        return_exceptions=True,
+    )
     
-    # Проверяем второй канал
-    try:
-        member = await context.bot.get_chat_member(CHANNEL_USERNAME_2, user_id)
-        channel2_ok = member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logger.warning("Failed to check TG subscription for user %s on %s: %s", user_id, CHANNEL_USERNAME_2, e)
+    statuses = []
+    for channel, member in zip((CONFIG.channel_id, CONFIG.channel_id_2), results):
+        if isinstance(member, Exception):
+            logger.warning("Failed to check TG subscription for user %s on %s: %s", user_id, channel, member)
+            statuses.append(False)
+        else:
+            statuses.append(member.status in ["member", "administrator", "creator"])
     
+    channel1_ok, channel2_ok = statuses
     return channel1_ok, channel2_ok
 
 
 async def get_bot_channel_status(context: ContextTypes.DEFAULT_TYPE) -> str:
     try:
-        bot_member = await context.bot.get_chat_member(CHANNEL_USERNAME, context.bot.id)
+        bot_member = await context.bot.get_chat_member(CONFIG.channel_id, context.bot.id)
         if bot_member.status == "administrator":
-            return f"Бот имеет права администратора в {CHANNEL_USERNAME} ✅"
+            return f"Бот имеет права администратора в {CONFIG.channel_id} ✅"
         else:
-            return f"⚠️ Бот не является администратором {CHANNEL_USERNAME}. Проверка подписки может работать некорректно."
+            return f"⚠️ Бот не является администратором {CONFIG.channel_id}. Проверка подписки может работать некорректно."
     except Exception as e:
-        logger.warning("Failed to get bot status in channel %s: %s", CHANNEL_USERNAME, e)
-        return f"❌ Не удалось проверить статус бота в {CHANNEL_USERNAME}. Убедитесь, что бот добавлен в канал как администратор."
+        logger.warning("Failed to get bot status in channel %s: %s", CONFIG.channel_id, e)
+        return f"❌ Не удалось проверить статус бота в {CONFIG.channel_id}. Убедитесь, что бот добавлен в канал как администратор."
+
+
+# Известные пользователи. Источник истины - таблица users в БД, здесь только
+# рабочая копия: держим её вне bot_data, чтобы persistence не
+# переписывал растущее множество при каждом сохранении.
+_known_users: Set[int] = set()
 
 
 def get_known_users(context: ContextTypes.DEFAULT_TYPE) -> Set[int]:
-    bd = context.bot_data
-    if "known_users" not in bd:
-        bd["known_users"] = set()
-    return bd["known_users"]
+    return _known_users
 
 
-def get_db_pool(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        return context.application.bot_data.get("db_pool")
-    except Exception:
-        return None
+# Пакетная запись пользователей из /start (создаётся в post_init при наличии БД)
+_user_upserts: Optional[UpsertQueue] = None
+
+
+async def mark_user_blocked(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+    """Пользователь заблокировал бота: убираем его из рассылок до следующего /start"""
+    _known_users.discard(user_id)
+    pool = get_db_pool(context)
+    if pool:
+        try:
+            await set_user_active(pool, user_id, False)
+        except Exception as e:
+            logger.warning("Failed to mark user %s inactive: %s", user_id, e)
+
+
+# (момент получения по monotonic(), статистика) - см. get_cached_user_stats
+_stats_cache: tuple[float, dict] = (0.0, {})
+
+
+async def get_cached_user_stats(pool) -> dict:
+    """Статистика пользователей с кешем на STATS_TTL секунд (обновления панели не бьют в БД)"""
+    global _stats_cache
+    cached_at, stats = _stats_cache
+    now = monotonic()
+    if stats and 0 <= now - cached_at < STATS_TTL:
+        return stats
+    stats = await get_user_stats(pool)
+    _stats_cache = (now, stats)
+    return stats
+
+
+# Пул соединений с БД (создаётся в post_init). Живёт вне bot_data: его нельзя
+# ни скопировать, ни сериализовать, а persistence копирует bot_data
+# целиком при каждом сохранении.
+_db_pool: Optional[asyncpg.Pool] = None
+
+
+def get_db_pool(context: ContextTypes.DEFAULT_TYPE) -> Optional[asyncpg.Pool]:
+    return _db_pool
+
+
+# Афиши хранятся в таблице posters. Здесь рабочая копия в порядке создания
+# (последняя - актуальная), которая обновляется вместе с БД. Держим её вне
+# bot_data, чтобы persistence не переписывал список на каждом сохранении.
+_all_posters: list[dict] = []
+# Готовый текст списка афиш для админки; сбрасывается при любом изменении списка
+_posters_list_text: Optional[str] = None
+
+
+def get_all_posters(context: ContextTypes.DEFAULT_TYPE) -> list[dict]:
+    return _all_posters
+
+
+def get_latest_poster(context: ContextTypes.DEFAULT_TYPE) -> Optional[dict]:
+    return _all_posters[-1] if _all_posters else None
+
+
+def _invalidate_posters_list() -> None:
+    global _posters_list_text
+    _posters_list_text = None
+
+
+def find_poster_index(poster_id: int) -> int:
+    """Позиция афиши с данным id из БД в списке (-1, если её уже нет)"""
+    for i, poster in enumerate(_all_posters):
+        if poster.get("id") == poster_id:
+            return i
+    return -1
+
+
+async def load_posters(app: Application) -> None:
+    """Загрузить афиши из БД; при первом запуске перенести их из bot_data"""
+    pool = _db_pool
+    legacy = app.bot_data.get("all_posters") or []
+    if not pool:
+        _all_posters[:] = legacy
+        return
+
+    posters = await get_posters(pool)
+    if not posters and legacy:
+        for p in legacy:
+            if p.get("file_id"):
+                poster_id = await insert_poster(pool, p["file_id"], p.get("caption") or "", p.get("ticket_url"))
+                posters.append({"id": poster_id, "file_id": p["file_id"],
+                                "caption": p.get("caption") or "", "ticket_url": p.get("ticket_url")})
+        logger.info("Migrated %d posters from bot_data to DB", len(posters))
+    for key in ("all_posters", "all_posters_ids", "poster"):
+        app.bot_data.pop(key, None)
+    _all_posters[:] = posters
+    _invalidate_posters_list()
+
+
+async def add_poster(context: ContextTypes.DEFAULT_TYPE, file_id: str, caption: str, ticket_url: Optional[str]) -> dict:
+    poster = {"id": None, "file_id": file_id, "caption": caption, "ticket_url": ticket_url}
+    pool = get_db_pool(context)
+    if pool:
+        try:
+            poster["id"] = await insert_poster(pool, file_id, caption, ticket_url)
+        except Exception as e:
+            logger.warning("Failed to save poster to DB: %s", e)
+    _all_posters.append(poster)
+    _invalidate_posters_list()
+    return poster
+
+
+async def remove_poster(context: ContextTypes.DEFAULT_TYPE, index: int) -> dict:
+    poster = _all_posters.pop(index)
+    _invalidate_posters_list()
+    pool = get_db_pool(context)
+    if pool and poster.get("id") is not None:
+        try:
+            await deactivate_poster(pool, poster["id"])
+        except Exception as e:
+            logger.warning("Failed to delete poster %s from DB: %s", poster["id"], e)
+    return poster
+
+
+async def set_latest_ticket_url(context: ContextTypes.DEFAULT_TYPE, url: str) -> bool:
+    poster = get_latest_poster(context)
+    if not poster:
+        return False
+    poster["ticket_url"] = url
+    _invalidate_posters_list()
+    pool = get_db_pool(context)
+    if pool and poster.get("id") is not None:
+        try:
+            await set_poster_ticket_url(pool, poster["id"], url)
+        except Exception as e:
+            logger.warning("Failed to save ticket url for poster %s: %s", poster["id"], e)
+    return True
+
+
+# ----------------------
+# Состояние пользователя
+# ----------------------
+
+@dataclass(slots=True)
+class PosterDraft:
+    """Черновик афиши, который админ собирает по шагам."""
+    step: str = "photo"
+    file_id: Optional[str] = None
+    caption: Optional[str] = None
+    ticket_url: Optional[str] = None
+
+
+@dataclass(slots=True)
+class UserState:
+    """Всё состояние пользователя в одном объекте под ключом "_s" в user_data."""
+    name: Optional[str] = None
+    gender: Optional[str] = None
+    age: Optional[int] = None
+    vk_id: Optional[str] = None
+    registered: bool = False
+    registration_step: Optional[str] = None
+    current_poster_index: Optional[int] = None
+    poster_draft: Optional[PosterDraft] = None
+    awaiting_vk: bool = False
+    awaiting_ticket: bool = False
+    awaiting_broadcast_text: bool = False
+    awaiting_username_check: bool = False
+    continuous_check_mode: bool = False
+    reply_keyboard_removed: bool = False
+    # Момент загрузки из БД по monotonic(); None - ещё не загружали или кеш сброшен
+    db_cached_at: Optional[float] = None
+
+
+# Ключи, которые раньше лежали прямо в user_data (переносятся при первом обращении)
+_LEGACY_USER_KEYS = (
+    "name", "gender", "age", "vk_id", "registered", "registration_step",
+    "current_poster_index", "awaiting_vk", "awaiting_ticket",
+    "awaiting_broadcast_text", "awaiting_username_check",
+    "continuous_check_mode", "reply_keyboard_removed",
+)
+
+
+def get_user_state(context: ContextTypes.DEFAULT_TYPE) -> UserState:
+    ud = context.user_data
+    st = ud.get("_s")
+    if st is None:
+        st = UserState()
+        for key in _LEGACY_USER_KEYS:
+            if key in ud:
+                setattr(st, key, ud.pop(key))
+        draft = ud.pop("poster_draft", None)
+        if draft:
+            st.poster_draft = PosterDraft(**draft)
+        ud.pop("_db_cached_at", None)
+        ud["_s"] = st
+    return st
+
+
+_USER_STATE_FIELDS = frozenset(f.name for f in fields(UserState))
+
+
+def user_data_from_json(data: dict) -> dict:
+    """Восстановить UserState из JSON, сохранённого persistence"""
+    st = data.get("_s")
+    if isinstance(st, dict):
+        draft = st.get("poster_draft")
+        # Время загрузки из БД относится к monotonic() прошлого процесса - не восстанавливаем
+        st = UserState(**{k: v for k, v in st.items() if k in _USER_STATE_FIELDS and k != "db_cached_at"})
+        st.poster_draft = PosterDraft(**draft) if draft else None
+        data["_s"] = st
+    return data
+
+
+def bot_data_from_json(data: dict) -> dict:
+    """Вернуть множествам из bot_data их тип (в JSON они хранятся списками)"""
+    if "admins" in data:
+        data["admins"] = set(data["admins"])
+    return data
 
 
 async def load_user_data_from_db(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Загружает данные пользователя из БД в context.user_data"""
+    """Загружает данные пользователя из БД в состояние пользователя
+    
+    Результат кешируется на USER_DATA_TTL секунд, чтобы навигация по меню
+    не делала SELECT на каждое нажатие кнопки.
+    """
     pool = get_db_pool(context)
     if not pool:
         logger.warning("No DB pool available for user %s", user_id)
         return
     
+    st = get_user_state(context)
+    if st.registration_step:
+        # Пока идёт регистрация, введённые поля есть только в памяти (в БД они
+        # пишутся одним upsert в конце) - не затираем их строкой из БД
+        return
+    now = monotonic()
+    # monotonic() обнуляется при перезапуске, поэтому отрицательная разница = устаревший кеш
+    if st.db_cached_at is not None and 0 <= now - st.db_cached_at < USER_DATA_TTL:
+        return
+    
     try:
         user_in_db = await get_user(pool, user_id)
-        logger.info("DB query result for user %s: %s", user_id, user_in_db)
+        logger.debug("DB query result for user %s: %s", user_id, user_in_db)
         
         if user_in_db:
             # Загружаем все доступные данные
-            context.user_data["name"] = user_in_db.get("name")
-            context.user_data["gender"] = user_in_db.get("gender")
-            context.user_data["age"] = user_in_db.get("age")
+            st.name = user_in_db.get("name")
+            st.gender = user_in_db.get("gender")
+            st.age = user_in_db.get("age")
             
             # Загружаем VK ID если есть
             if user_in_db.get("vk_id"):
-                context.user_data["vk_id"] = user_in_db.get("vk_id")
+                st.vk_id = user_in_db.get("vk_id")
             
             # Проверяем полноту регистрации - нужны минимум имя, пол и возраст
             has_required_data = (
@@ -235,49 +555,47 @@ async def load_user_data_from_db(context: ContextTypes.DEFAULT_TYPE, user_id: in
             )
             
             if has_required_data:
-                context.user_data["registered"] = True
+                st.registered = True
                 logger.info("User %s fully registered - loaded from DB: name=%s, gender=%s, age=%s", 
                            user_id, user_in_db.get("name"), user_in_db.get("gender"), user_in_db.get("age"))
             else:
-                context.user_data["registered"] = False
+                st.registered = False
                 logger.info("User %s in DB but incomplete: name=%s, gender=%s, age=%s", 
                            user_id, user_in_db.get("name"), user_in_db.get("gender"), user_in_db.get("age"))
         else:
             # Пользователя нет в БД - сбрасываем регистрацию
-            context.user_data["registered"] = False
-            context.user_data.pop("name", None)
-            context.user_data.pop("gender", None)
-            context.user_data.pop("age", None)
-            context.user_data.pop("vk_id", None)
+            st.registered = False
+            st.name = st.gender = st.age = st.vk_id = None
             logger.info("User %s not found in DB - reset registration", user_id)
+        st.db_cached_at = now
     except Exception as e:
         logger.warning("Failed to load user data from DB for user %s: %s", user_id, e)
 
 
 
 
-def get_admins(context: ContextTypes.DEFAULT_TYPE) -> Set[int]:
-    bd = context.bot_data
-    if "admins" not in bd:
-        bd["admins"] = set()
-    
-    # Всегда добавляем админов из .env (на случай если добавили новых)
-    if ADMIN_USER_ID:
-        bd["admins"].add(ADMIN_USER_ID)
-    if ADMIN_USER_ID_2:
-        bd["admins"].add(ADMIN_USER_ID_2)
-    if ADMIN_USER_ID_3:
-        bd["admins"].add(ADMIN_USER_ID_3)
-    if ADMIN_USER_ID_4:
-        bd["admins"].add(ADMIN_USER_ID_4)
-    
-    return bd["admins"]
+_EMPTY_FS: frozenset = frozenset()
+
+
+def get_dynamic_admins(context: ContextTypes.DEFAULT_TYPE) -> Set[int]:
+    """Админы, назначенные через /make_admin (хранятся в bot_data)."""
+    return context.bot_data.setdefault("admins", set())
+
+
+def get_admins(context: ContextTypes.DEFAULT_TYPE) -> frozenset:
+    # Админы из .env (неизменяемые) плюс назначенные через /make_admin
+    return CONFIG.admin_ids | context.bot_data.get("admins", _EMPTY_FS)
+
+
+def is_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    return user_id in CONFIG.admin_ids or user_id in context.bot_data.get("admins", _EMPTY_FS)
 
 
 async def auto_update_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Автоматически обновляет username пользователя в БД если он изменился.
     Функция безопасна - если что-то пойдет не так, основная логика продолжит работать.
+    Запускается через application.create_task, чтобы SELECT/UPDATE не задерживали ответ.
     """
     try:
         user = update.effective_user
@@ -292,27 +610,81 @@ async def auto_update_username(update: Update, context: ContextTypes.DEFAULT_TYP
         if not pool:
             return
         
-        # Получаем данные пользователя из БД
-        user_in_db = await get_user(pool, user.id)
-        if not user_in_db:
-            return  # Пользователь не зарегистрирован - username обновится при регистрации
-        
-        # Проверяем изменился ли username
-        db_username = user_in_db.get("username")
-        if db_username == current_username:
-            return  # Username не изменился
-        
-        # Обновляем username в БД
-        await upsert_user(
-            pool=pool,
-            tg_id=user.id,
-            username=current_username
-        )
-        logger.info(f"Auto-updated username for user {user.id}: {db_username} -> {current_username}")
+        # Чтение и запись идут через одно соединение из пула
+        async with pool.acquire() as conn:
+            # Получаем данные пользователя из БД
+            user_in_db = await get_user(conn, user.id)
+            if not user_in_db:
+                return  # Пользователь не зарегистрирован - username обновится при регистрации
+            
+            # Проверяем изменился ли username
+            db_username = user_in_db.get("username")
+            if db_username == current_username:
+                return  # Username не изменился
+            
+            # Обновляем username в БД
+            await upsert_user(
+                pool=conn,
+                tg_id=user.id,
+                username=current_username
+            )
+        if db_username:
+            _tg_usernames.pop(db_username.lower(), None)
+        logger.info("Auto-updated username for user %s: %s -> %s", user.id, db_username, current_username)
         
     except Exception as e:
         # Логируем ошибку, но не прерываем выполнение
-        logger.warning(f"Failed to auto-update username for user {update.effective_user.id if update.effective_user else 'unknown'}: {e}")
+        logger.warning("Failed to auto-update username for user %s: %s",
+                       update.effective_user.id if update.effective_user else "unknown", e)
+
+
+# username (в нижнем регистре) -> (момент поиска по monotonic(), tg_id)
+USERNAME_TTL = 300
+_USERNAME_CACHE_SIZE = 4096
+_tg_usernames: "OrderedDict[str, tuple[float, int]]" = OrderedDict()
+
+
+async def resolve_tg_username(context: ContextTypes.DEFAULT_TYPE, username: str) -> Optional[int]:
+    """Telegram ID по username: из БД, а если там нет - через get_chat.
+
+    Найденные ID кешируются на USERNAME_TTL секунд, чтобы повторные проверки
+    в режиме массовой проверки не ходили ни в БД, ни в Telegram.
+    """
+    key = username.lower()
+    now = monotonic()
+    cached = _tg_usernames.get(key)
+    if cached is not None:
+        if 0 <= now - cached[0] < USERNAME_TTL:
+            _tg_usernames.move_to_end(key)
+            return cached[1]
+        del _tg_usernames[key]
+
+    target_user_id = None
+    pool = get_db_pool(context)
+    if pool:
+        try:
+            user_in_db = await get_user_by_username(pool, username)
+            if user_in_db:
+                target_user_id = user_in_db.get("tg_id")
+                logger.info("Found user by username @%s: ID=%s", username, target_user_id)
+            else:
+                logger.info("User @%s not found in DB, trying get_chat...", username)
+        except Exception as e:
+            logger.error("Error searching user by username in DB: %s", e)
+    if not target_user_id:
+        # Если не нашли в БД (или она недоступна), пробуем через get_chat (для публичных профилей)
+        try:
+            target_chat = await context.bot.get_chat(f"@{username}")
+            target_user_id = target_chat.id
+            logger.info("Found user by get_chat @%s: ID=%s", username, target_user_id)
+        except Exception as e:
+            logger.warning("Failed to get_chat for @%s: %s", username, e)
+            return None
+
+    _tg_usernames[key] = (now, target_user_id)
+    if len(_tg_usernames) > _USERNAME_CACHE_SIZE:
+        _tg_usernames.popitem(last=False)
+    return target_user_id
 
 
 # ----------------------
@@ -320,6 +692,8 @@ async def auto_update_username(update: Update, context: ContextTypes.DEFAULT_TYP
 # ----------------------
 
 VK_PROFILE_RE = re.compile(r"(?:https?://)?(?:www\.)?vk\.com/(id\d+|[A-Za-z0-9_\.]+)", re.IGNORECASE)
+# Ввод пользователя при привязке: 123456789, id123456789 или никнейм (durov, ivan_petrov)
+_VK_INPUT_RE = re.compile(r"(?:id)?\d+|(?=[\w.]*[^\W_])[\w.]{3,}", re.IGNORECASE | re.ASCII)
 
 
 def extract_vk_id(text: str) -> Optional[str]:
@@ -335,27 +709,130 @@ def extract_vk_id(text: str) -> Optional[str]:
     return None
 
 
+# Тексты формы привязки VK (собираются один раз, а не на каждое нажатие)
+_VK_ID_HELP = (
+    "Поддерживаемые форматы:\n"
+    "• Цифры: 123456789\n"
+    "• ID: id123456789\n"
+    "• Никнейм: durov, ivan_petrov\n\n"
+    "Как найти ID аккаунта:\n"
+    "1. Откройте свой профиль VK\n"
+    "2. Скопируйте из адресной строки:\n"
+    "   • vk.com/durov → отправьте: durov\n"
+    "   • vk.com/id123456789 → отправьте: 123456789\n\n"
+    "⚠️ Убедитесь, что подписки в профиле открыты для просмотра"
+)
+_VK_LINK_TEXT_NEW = (
+    "🔗 Привязка VK аккаунта\n\n"
+    "Отправьте ID вашего VK аккаунта для проверки подписки:\n\n"
+    + _VK_ID_HELP
+)
+_VK_LINK_TEXT_RELINK_TMPL = (
+    "🔄 Перепривязка VK аккаунта\n\n"
+    "Текущий VK ID: {current_vk}\n\n"
+    "Отправьте новый ID вашего VK аккаунта:\n\n"
+    + _VK_ID_HELP
+)
+
+
+VK_API_VERSION = "5.131"
+
+# Общий HTTP-клиент для VK API: одно keep-alive соединение вместо нового
+# TCP+TLS рукопожатия на каждую проверку. Хранится на уровне модуля, а не в
+# bot_data, чтобы persistence не пытался его сериализовать.
+_vk_http: Optional[httpx.AsyncClient] = None
+
+
+def get_vk_http() -> httpx.AsyncClient:
+    global _vk_http
+    if _vk_http is None or _vk_http.is_closed:
+        _vk_http = httpx.AsyncClient(
+            base_url="https://api.vk.com",
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _vk_http
+
+
+async def close_vk_http() -> None:
+    global _vk_http
+    if _vk_http is not None:
+        await _vk_http.aclose()
+        _vk_http = None
+
+
+async def vk_api(method: str, params: dict, post: bool = False) -> dict:
+    """Вызов метода VK API через общий клиент, возвращает разобранный JSON"""
+    payload = {**params, "access_token": CONFIG.vk_token, "v": VK_API_VERSION}
+    client = get_vk_http()
+    if post:
+        r = await client.post(f"/method/{method}", data=payload)
+    else:
+        r = await client.get(f"/method/{method}", params=payload)
+    return orjson.loads(r.content)
+
+
+
+# Числовой id группы не меняется - запрашиваем groups.getById один раз
+_vk_group_id: Optional[int] = None
+_vk_group_id_lock = asyncio.Lock()
+
+# screen name (в нижнем регистре) -> числовой id пользователя VK
+_VK_SCREEN_NAME_CACHE_SIZE = 1024
+_vk_screen_names: "OrderedDict[str, str]" = OrderedDict()
+
+
+async def get_vk_group_id() -> Optional[int]:
+    """Числовой id группы CONFIG.vk_group_domain (кешируется после первого запроса)"""
+    global _vk_group_id
+    if _vk_group_id is not None:
+        return _vk_group_id
+    async with _vk_group_id_lock:
+        if _vk_group_id is None:
+            group_data = await vk_api("groups.getById", {"group_id": CONFIG.vk_group_domain})
+            if 'error' in group_data:
+                logger.warning("VK API error getting group info: %s", group_data['error'])
+                return None
+            _vk_group_id = group_data['response'][0]['id']
+    return _vk_group_id
+
+
+async def resolve_vk_screen_name(screen_name: str) -> Optional[str]:
+    """screen name -> числовой id пользователя VK (с LRU-кешем)"""
+    key = screen_name.lower()
+    cached = _vk_screen_names.get(key)
+    if cached is not None:
+        _vk_screen_names.move_to_end(key)
+        return cached
+
+    rj = await vk_api("utils.resolveScreenName", {"screen_name": screen_name})
+    if 'error' in rj or not rj.get('response'):
+        logger.warning("VK resolveScreenName failed for %s: %s", screen_name, rj.get('error'))
+        return None
+    resp = rj['response']
+    if resp.get('type') != 'user':
+        logger.warning("Resolved name is not a user: %s", resp)
+        return None
+
+    user_id_numeric = str(resp.get('object_id'))
+    _vk_screen_names[key] = user_id_numeric
+    if len(_vk_screen_names) > _VK_SCREEN_NAME_CACHE_SIZE:
+        _vk_screen_names.popitem(last=False)
+    return user_id_numeric
+
 async def vk_is_member(vk_user: str) -> Optional[bool]:
-    if not VK_TOKEN:
+    if not CONFIG.vk_token:
         return None  # cannot verify
     # groups.isMember accepts group_id (domain) and user_id
-    params = {
-        "group_id": VK_GROUP_DOMAIN,
-        "user_id": vk_user,
-        "access_token": VK_TOKEN,
-        "v": "5.131",
-    }
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            r = await client.get("https://api.vk.com/method/groups.isMember", params=params)
-            data = r.json()
-            if "error" in data:
-                logger.warning("VK API error: %s", data["error"])
-                return None
-            resp = data.get("response")
-            if isinstance(resp, dict):
-                return bool(resp.get("member", 0))
-            return bool(resp)
+        data = await vk_api("groups.isMember", {"group_id": CONFIG.vk_group_domain, "user_id": vk_user})
+        if "error" in data:
+            logger.warning("VK API error: %s", data["error"])
+            return None
+        resp = data.get("response")
+        if isinstance(resp, dict):
+            return bool(resp.get("member", 0))
+        return bool(resp)
     except Exception as e:
         logger.warning("VK check failed: %s", e)
         return None
@@ -368,122 +845,190 @@ async def is_user_subscribed_vk(vk_user_id: str) -> Optional[bool]:
       - True/False — если проверка удалась
       - None — если проверить не удалось (ошибка VK API/сеть)
     """
-    if not VK_ENABLED or not VK_TOKEN:
+    if not VK_ENABLED or not CONFIG.vk_token:
         return None
 
     try:
-        import aiohttp
+        # 1) Получаем numeric group_id (кешируется)
+        group_id = await get_vk_group_id()
+        if group_id is None:
+            return None
+
+        # 2) Нормализуем user_id: поддерживаем 'id123', '123', 'durov'
+        raw = (vk_user_id or '').strip()
+        if raw.lower().startswith('id') and raw[2:].isdigit():
+            user_id_numeric = raw[2:]
+        elif raw.isdigit():
+            user_id_numeric = raw
+        else:
+            user_id_numeric = await resolve_vk_screen_name(raw)
+            if user_id_numeric is None:
+                return None
 
-        # 1) Получаем numeric group_id по домену
-        async with aiohttp.ClientSession() as session:
-            group_url = (
-                "https://api.vk.com/method/groups.getById"
-                f"?group_id={VK_GROUP_DOMAIN}&access_token={VK_TOKEN}&v=5.131"
-            )
-            async with session.get(group_url) as resp:
-                group_data = await resp.json()
-                if 'error' in group_data:
-                    logger.warning("VK API error getting group info: %s", group_data['error'])
-                    return None
-                group_id = group_data['response'][0]['id']
-
-            # 2) Нормализуем user_id: поддерживаем 'id123', '123', 'durov'
-            raw = (vk_user_id or '').strip()
-            if raw.lower().startswith('id') and raw[2:].isdigit():
-                user_id_numeric = raw[2:]
-            elif raw.isdigit():
-                user_id_numeric = raw
-            else:
-                # resolve screen name -> object_id
-                resolve_url = (
-                    "https://api.vk.com/method/utils.resolveScreenName"
-                    f"?screen_name={raw}&access_token={VK_TOKEN}&v=5.131"
-                )
-                async with session.get(resolve_url) as r2:
-                    rj = await r2.json()
-                    if 'error' in rj or not rj.get('response'):
-                        logger.warning("VK resolveScreenName failed for %s: %s", raw, rj.get('error'))
-                        return None
-                    resp = rj['response']
-                    if resp.get('type') != 'user':
-                        logger.warning("Resolved name is not a user: %s", resp)
-                        return None
-                    user_id_numeric = str(resp.get('object_id'))
-
-            # 3) Проверяем членство
-            check_url = (
-                "https://api.vk.com/method/groups.isMember"
-                f"?group_id={group_id}&user_id={user_id_numeric}&access_token={VK_TOKEN}&v=5.131"
-            )
-            async with session.get(check_url) as resp:
-                data = await resp.json()
-                if 'error' in data:
-                    logger.warning("VK API error checking membership: %s", data['error'])
-                    return None
-                # ответ может быть числом 1/0 или словарем {member: 1}
-                resp_val = data.get('response')
-                if isinstance(resp_val, dict):
-                    return bool(resp_val.get('member', 0))
-                return bool(resp_val)
+        # 3) Проверяем членство
+        data = await vk_api("groups.isMember", {"group_id": group_id, "user_id": user_id_numeric})
+        if 'error' in data:
+            logger.warning("VK API error checking membership: %s", data['error'])
+            return None
+        # ответ может быть числом 1/0 или словарем {member: 1}
+        resp_val = data.get('response')
+        if isinstance(resp_val, dict):
+            return bool(resp_val.get('member', 0))
+        return bool(resp_val)
 
     except Exception as e:
         logger.warning("Failed to check VK subscription for %s: %s", vk_user_id, e)
         return None
 
 
+# Привязанные VK ID по tg_id: загружаются из БД при старте, дальше обновляются
+# по NOTIFY из БД (VkIdListener) и при привязке. Держим вне bot_data, чтобы
+# persistence не сохранял словарь.
+_vk_ids: dict[int, str] = {}
+
+# Подписка на изменения vk_id в БД (создаётся в post_init при наличии БД)
+_vk_listener: Optional[VkIdListener] = None
+
+
+def _on_vk_change(tg_id: int, vk_id: Optional[str]) -> None:
+    if vk_id:
+        _vk_ids[tg_id] = vk_id
+    else:
+        _vk_ids.pop(tg_id, None)
+
+
+def _on_vk_snapshot(vk_data: dict[int, str]) -> None:
+    # Снимок полный: после переподключения выбрасываем и отвязанные за время обрыва
+    _vk_ids.clear()
+    _vk_ids.update(vk_data)
+
+
+async def _start_vk_sync(pool: asyncpg.Pool) -> None:
+    """Подписка на изменения vk_id со снимком; без подписки - только снимок"""
+    global _vk_listener
+    _vk_listener = VkIdListener(pool, _on_vk_change, _on_vk_snapshot)
+    try:
+        await _vk_listener.start()
+    except Exception as e:
+        logger.warning("Failed to listen for VK id changes: %s", e)
+        _vk_listener = None
+        _on_vk_snapshot(await load_user_vk_data(pool))
+
+
+async def get_linked_vk_id(context: ContextTypes.DEFAULT_TYPE, tg_id: int) -> Optional[str]:
+    """VK ID пользователя: из кеша, а при промахе - из БД"""
+    vk_id = _vk_ids.get(tg_id)
+    if vk_id:
+        return vk_id
+    pool = get_db_pool(context)
+    if not pool:
+        return None
+    try:
+        user_in_db = await get_user(pool, tg_id)
+    except Exception as e:
+        logger.warning("Failed to load VK id for %s: %s", tg_id, e)
+        return None
+    vk_id = user_in_db.get("vk_id") if user_in_db else None
+    if vk_id:
+        _vk_ids[tg_id] = vk_id
+    return vk_id
+
+
+async def check_linked_vk(context: ContextTypes.DEFAULT_TYPE, tg_id: int) -> tuple[Optional[str], Optional[bool]]:
+    """VK ID, привязанный к пользователю Telegram, и статус его подписки на группу"""
+    vk_id = await get_linked_vk_id(context, tg_id)
+    if not vk_id or not VK_ENABLED:
+        return vk_id, None
+    return vk_id, await is_user_subscribed_vk(vk_id)
+
+
 async def broadcast_to_vk(poster_data: dict) -> bool:
     """Отправить афишу в VK группу largent.tusa"""
-    if not VK_ENABLED or not VK_TOKEN:
+    if not VK_ENABLED or not CONFIG.vk_token:
         logger.info("VK broadcast disabled - no token")
         return False
     
     try:
-        import aiohttp
-        
-        # Получаем данные афиши
-        caption = poster_data.get('caption', '')
+        # Формируем текст поста из данных афиши
         ticket_url = poster_data.get('ticket_url', '')
+        ticket_line = f"\n\n🎫 Билеты: {ticket_url}" if ticket_url else ""
+        post_text = f"{poster_data.get('caption', '')}{ticket_line}"
         
-        # Формируем текст поста
-        post_text = caption
-        if ticket_url:
-            post_text += f"\n\n🎫 Билеты: {ticket_url}"
+        # Получаем ID группы
+        group_id = await get_vk_group_id()
+        if group_id is None:
+            logger.error("VK broadcast aborted: group id for %s is unknown", CONFIG.vk_group_domain)
+            return False
         
-        async with aiohttp.ClientSession() as session:
-            # Получаем ID группы
-            group_url = f"https://api.vk.com/method/groups.getById?group_id={VK_GROUP_DOMAIN}&access_token={VK_TOKEN}&v=5.131"
-            async with session.get(group_url) as resp:
-                group_data = await resp.json()
-                if 'error' in group_data:
-                    logger.error("VK API error getting group info: %s", group_data['error'])
-                    return False
-                
-                group_id = group_data['response'][0]['id']
-            
-            # Отправляем пост на стену группы
-            post_url = f"https://api.vk.com/method/wall.post"
-            post_data = {
-                'owner_id': f'-{group_id}',
-                'message': post_text,
-                'from_group': 1,
-                'access_token': VK_TOKEN,
-                'v': '5.131'
-            }
-            
-            async with session.post(post_url, data=post_data) as resp:
-                result = await resp.json()
-                if 'error' in result:
-                    logger.error("VK API error posting: %s", result['error'])
-                    return False
-                
-                logger.info("Successfully posted to VK group: post_id=%s", result['response']['post_id'])
-                return True
+        # Отправляем пост на стену группы
+        result = await vk_api(
+            "wall.post",
+            {'owner_id': f'-{group_id}', 'message': post_text, 'from_group': 1},
+            post=True,
+        )
+        if 'error' in result:
+            logger.error("VK API error posting: %s", result['error'])
+            return False
+        
+        logger.info("Successfully posted to VK group: post_id=%s", result['response']['post_id'])
+        return True
                 
     except Exception as e:
         logger.error("Failed to broadcast to VK: %s", e)
         return False
 
 
+# Статичные клавиатуры: собираются один раз при импорте
+_MAIN_MENU_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")]])
+_GO_TO_MENU_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🎉 Перейти в меню", callback_data="back_to_menu")]])
+_CANCEL_TO_MENU_KB = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="back_to_menu")]])
+_RETRY_VK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Попробовать еще раз", callback_data="link_vk")]])
+_BACK_TO_PANEL_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
+_STOP_CHECK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]])
+_OPEN_ADMIN_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin")]])
+# Шаги мастера создания афиши
+_POSTER_STEP_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Отмена", callback_data="admin:cancel_poster")],
+    [InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")],
+])
+_CONFIRM_POSTER_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Подтвердить", callback_data="admin:confirm_poster")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="admin:cancel_poster")],
+    [InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")],
+])
+_GENDER_TEXT = {"male": "мужской", "female": "женский"}
+_GENDER_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👨 Мужской", callback_data="gender_male")],
+    [InlineKeyboardButton("👩 Женский", callback_data="gender_female")]
+])
+_ADMIN_KB = InlineKeyboardMarkup([
+    # Управление афишами
+    [
+        InlineKeyboardButton("🧩 Создать афишу", callback_data="admin:create_poster"),
+        InlineKeyboardButton("📋 Список афиш", callback_data="admin:list_posters")
+    ],
+    [
+        InlineKeyboardButton("📤 Разослать афишу", callback_data="admin:broadcast_now"),
+        InlineKeyboardButton("🗑 Удалить афишу", callback_data="admin:delete_poster")
+    ],
+    # Настройки и рассылки
+    [
+        InlineKeyboardButton("🔗 Задать ссылку", callback_data="admin:set_ticket"),
+        InlineKeyboardButton("📝 Текстовая рассылка", callback_data="admin:broadcast_text")
+    ],
+    # Пользователи
+    [
+        InlineKeyboardButton("🔍 Проверка по нику", callback_data="admin:check_by_username"),
+        InlineKeyboardButton("🔄 Обновить", callback_data="admin:refresh")
+    ],
+    [
+        InlineKeyboardButton("👥 Пользователи", callback_data="admin:users_count")
+    ],
+    # Выход
+    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")]
+])
+
+
 # ----------------------
 # Handlers
 # ----------------------
@@ -494,79 +1039,66 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     # Автообновление username в фоне
-    await auto_update_username(update, context)
+    context.application.create_task(auto_update_username(update, context), update=update)
     
     get_known_users(context).add(user.id)
     
-    # Создаем минимальную запись в БД если её нет
-    pool = get_db_pool(context)
-    if pool:
-        try:
-            await upsert_user(pool, tg_id=user.id, username=user.username)
-        except Exception as e:
-            logger.warning("DB upsert on /start failed: %s", e)
+    # Создаем минимальную запись в БД если её нет (пишется пачкой в фоне)
+    if _user_upserts:
+        _user_upserts.put(user.id, user.username)
     
     # Загружаем данные пользователя из БД
     await load_user_data_from_db(context, user.id)
     
     # Проверяем, завершена ли регистрация пользователя более надежно
-    user_data = context.user_data
-    is_registered = (
-        user_data.get("registered") == True and 
-        user_data.get("name") and 
-        user_data.get("gender") and 
-        user_data.get("age") is not None
-    )
+    st = get_user_state(context)
+    name, gender, age, vk_id, registered = st.name, st.gender, st.age, st.vk_id, st.registered
+    is_registered = registered and name and gender and age is not None
     
     # Проверяем незавершенную регистрацию
-    has_partial_data = user_data.get("name") or user_data.get("gender") or user_data.get("age") is not None
+    has_partial_data = name or gender or age is not None
     
     logger.info("Start command for user %s: registered=%s, name=%s, gender=%s, age=%s", 
-               user.id, user_data.get("registered"), user_data.get("name"), 
-               user_data.get("gender"), user_data.get("age"))
+               user.id, registered, name, gender, age)
     
     if is_registered:
         # Пользователь уже зарегистрирован - показываем сообщение и кнопку меню
         # Сбрасываем флаг регистрации если он остался
-        user_data.pop("registration_step", None)
-        user_data.pop("awaiting_vk", None)
-        user_data.pop("awaiting_username_check", None)
+        st.registration_step = None
+        st.awaiting_vk = False
+        st.awaiting_username_check = False
         
-        kb = [[InlineKeyboardButton("🎉 Перейти в меню", callback_data="back_to_menu")]]
+        kb = _GO_TO_MENU_KB
         await update.effective_chat.send_message(
             "🎉 Вы уже зарегистрированы у нас на вечеринках!\n\n"
             f"👤 Ваши данные:\n"
-            f"• Имя: {user_data.get('name', 'Не указано')}\n"
-            f"• Пол: {'Мужской' if user_data.get('gender') == 'male' else 'Женский' if user_data.get('gender') == 'female' else 'Не указан'}\n"
-            f"• Возраст: {user_data.get('age', 'Не указан')} лет\n"
-            f"• VK профиль: {'Привязан' if user_data.get('vk_id') else 'Не привязан'}\n\n"
+            f"• Имя: {name}\n"
+            f"• Пол: {'Мужской' if gender == 'male' else 'Женский' if gender == 'female' else 'Не указан'}\n"
+            f"• Возраст: {age} лет\n"
+            f"• VK профиль: {'Привязан' if vk_id else 'Не привязан'}\n\n"
             "Добро пожаловать обратно! 🥳",
-            reply_markup=InlineKeyboardMarkup(kb)
+            reply_markup=kb
         )
         return
     
     # Если есть частичные данные, продолжаем с того места где остановились
     if has_partial_data and not is_registered:
         # Определяем на каком этапе остановились
-        if not user_data.get("name"):
-            user_data["registration_step"] = "name"
+        if not name:
+            st.registration_step = "name"
             await update.effective_chat.send_message(
                 "👋 Продолжим регистрацию!\n\n"
                 "Как вас зовут? (Введите ваше имя)"
             )
-        elif not user_data.get("gender"):
-            user_data["registration_step"] = "gender"
-            kb = [
-                [InlineKeyboardButton("👨 Мужской", callback_data="gender_male")],
-                [InlineKeyboardButton("👩 Женский", callback_data="gender_female")]
-            ]
+        elif not gender:
+            st.registration_step = "gender"
             await update.effective_chat.send_message(
-                f"Отлично, {user_data.get('name')}! 😊\n\n"
+                f"Отлично, {name}! 😊\n\n"
                 "Укажите ваш пол:",
-                reply_markup=InlineKeyboardMarkup(kb)
+                reply_markup=_GENDER_KB
             )
-        elif user_data.get("age") is None:
-            user_data["registration_step"] = "age"
+        elif age is None:
+            st.registration_step = "age"
             await update.effective_chat.send_message(
                 "Последний шаг! 🎯\n\n"
                 "Укажите ваш возраст (числом):\n"
@@ -575,7 +1107,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     # Начинаем регистрацию с начала
-    user_data["registration_step"] = "name"
+    st.registration_step = "name"
     logger.info("Starting registration for user %s", user.id)
     await update.effective_chat.send_message(
         "🎉 Добро пожаловать на наши вечеринки!\n\n"
@@ -591,7 +1123,7 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     # Автообновление username в фоне
-    await auto_update_username(update, context)
+    context.application.create_task(auto_update_username(update, context), update=update)
 
     # Добавляем пользователя в известные
     get_known_users(context).add(user.id)
@@ -600,17 +1132,12 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await load_user_data_from_db(context, user.id)
 
     # Проверяем регистрацию более надежно
-    user_data = context.user_data
-    is_registered = (
-        user_data.get("registered") == True and 
-        user_data.get("name") and 
-        user_data.get("gender") and 
-        user_data.get("age") is not None
-    )
+    st = get_user_state(context)
+    name, gender, age, registered = st.name, st.gender, st.age, st.registered
+    is_registered = registered and name and gender and age is not None
     
     logger.info("Menu command for user %s: registered=%s, name=%s, gender=%s, age=%s", 
-               user.id, user_data.get("registered"), user_data.get("name"), 
-               user_data.get("gender"), user_data.get("age"))
+               user.id, registered, name, gender, age)
     
     if not is_registered:
         logger.info("User %s not registered - showing registration message", user.id)
@@ -624,8 +1151,52 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await show_main_menu(update, context)
 
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показать главное меню с текущей афишей и навигацией"""
+async def safe_delete(msg) -> None:
+    """Удалить сообщение, если получится (старое, уже удалённое и т.п. - не ошибка)"""
+    with suppress(Exception):
+        await msg.delete()
+
+
+def _is_not_modified(e: BadRequest) -> bool:
+    return "message is not modified" in str(e).lower()
+
+
+async def replace_query_message(
+    update: Update,
+    query: CallbackQuery,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    parse_mode: Optional[str] = None,
+) -> None:
+    """Заменить сообщение с кнопкой текстом.
+    
+    Текстовое сообщение правим на месте (один запрос). Фото в текст
+    превратить нельзя, поэтому его удаляем и отправляем новое сообщение.
+    """
+    msg = query.message
+    if msg is not None and msg.text is not None:
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            return
+        except BadRequest as e:
+            if _is_not_modified(e):
+                return
+            logger.debug("Cannot edit message, sending a new one: %s", e)
+    if msg is not None:
+        await safe_delete(msg)
+    await update.effective_chat.send_message(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+
+async def show_main_menu(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    edit_from: Optional[CallbackQuery] = None,
+) -> None:
+    """Показать главное меню с текущей афишей и навигацией
+    
+    edit_from - callback-запрос, сообщение которого заменяется меню: фото
+    правится через edit_message_media, остальное удаляется и отправляется заново.
+    """
     user = update.effective_user
     if not user:
         return
@@ -634,37 +1205,27 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await load_user_data_from_db(context, user.id)
     
     # Получаем все афиши
-    all_posters = context.bot_data.get("all_posters", [])
-    current_poster = context.bot_data.get("poster")
-    
-    # Если есть текущая афиша, но её нет в списке всех афиш, добавляем
-    if current_poster and current_poster not in all_posters:
-        all_posters.append(current_poster)
-        context.bot_data["all_posters"] = all_posters
+    all_posters = get_all_posters(context)
     
     if not all_posters:
         # Нет афиш - показываем заглушку
-        kb = []
-        if user.id in get_admins(context):
-            kb.append([InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin")])
-        
-        await update.effective_chat.send_message(
-            "🎭 Пока нет доступных афиш\n\n"
-            "Следите за обновлениями!",
-            reply_markup=InlineKeyboardMarkup(kb) if kb else None
-        )
+        text = "🎭 Пока нет доступных афиш\n\nСледите за обновлениями!"
+        markup = _OPEN_ADMIN_KB if is_admin(context, user.id) else None
+        if edit_from is not None:
+            await replace_query_message(update, edit_from, text, markup)
+        else:
+            await update.effective_chat.send_message(text, reply_markup=markup)
         return
     
     # Получаем текущий индекс афиши (по умолчанию - последняя)
-    if "current_poster_index" not in context.user_data and all_posters:
-        context.user_data["current_poster_index"] = len(all_posters) - 1
-    current_poster_index = context.user_data.get("current_poster_index", 0)
-    if current_poster_index >= len(all_posters):
-        current_poster_index = len(all_posters) - 1
-        context.user_data["current_poster_index"] = current_poster_index
+    st = get_user_state(context)
+    total = len(all_posters)
+    last = total - 1
+    current_poster_index = st.current_poster_index
+    if current_poster_index is None or current_poster_index > last:
+        current_poster_index = st.current_poster_index = last
     elif current_poster_index < 0:
-        current_poster_index = 0
-        context.user_data["current_poster_index"] = current_poster_index
+        current_poster_index = st.current_poster_index = 0
     
     # Показываем текущую афишу
     poster = all_posters[current_poster_index]
@@ -673,11 +1234,11 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     nav_buttons = []
     
     # Навигация по афишам (если больше одной)
-    if len(all_posters) > 1:
+    if total > 1:
         nav_row = []
         if current_poster_index > 0:
             nav_row.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data="poster_prev"))
-        if current_poster_index < len(all_posters) - 1:
+        if current_poster_index < last:
             nav_row.append(InlineKeyboardButton("➡️ Следующая", callback_data="poster_next"))
         if nav_row:
             nav_buttons.append(nav_row)
@@ -691,18 +1252,23 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # 2. Кнопка привязки/перепривязки VK для всех пользователей
     if VK_ENABLED:
-        vk_id = context.user_data.get("vk_id")
+        vk_id = st.vk_id
         if not vk_id:
             action_buttons.append([InlineKeyboardButton("🔗 Привязать VK профиль", callback_data="link_vk")])
         else:
             action_buttons.append([InlineKeyboardButton("🔄 Перепривязать VK", callback_data="link_vk")])
     
     # Админские кнопки
-    if user and user.id in get_admins(context):
+    if user and is_admin(context, user.id):
         admin_row = []
         admin_row.append(InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin"))
-        if len(all_posters) > 0:
-            admin_row.append(InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_poster:{current_poster_index}"))
+        if total > 0:
+            # По id из БД, чтобы старая кнопка не удалила афишу, сдвинувшуюся на это место
+            if poster.get("id") is not None:
+                delete_data = f"delete_poster_id:{poster['id']}"
+            else:
+                delete_data = f"delete_poster:{current_poster_index}"
+            admin_row.append(InlineKeyboardButton("🗑 Удалить", callback_data=delete_data))
         action_buttons.append(admin_row)
     
     # Собираем все кнопки
@@ -711,28 +1277,48 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Отправляем или редактируем афишу
     try:
         caption = poster.get("caption", "")
-        if len(all_posters) > 1:
-            caption += f"\n\n📍 Афиша {current_poster_index + 1} из {len(all_posters)}"
+        if total > 1:
+            caption += f"\n\n📍 Афиша {current_poster_index + 1} из {total}"
         
-        # Убираем админскую клавиатуру если была
-        keyboard_remove_msg = await update.effective_chat.send_message(
-            "📋 Главное меню", 
-            reply_markup=ReplyKeyboardRemove()
-        )
+        # Убираем старую админскую reply-клавиатуру, если она могла остаться.
+        # Бот её больше не отправляет, поэтому достаточно сделать это один раз
+        # на пользователя, а не отправлять+удалять сообщение при каждом открытии меню.
+        keyboard_remove_msg = None
+        if not st.reply_keyboard_removed:
+            keyboard_remove_msg = await update.effective_chat.send_message(
+                "📋 Главное меню", 
+                reply_markup=ReplyKeyboardRemove()
+            )
+            st.reply_keyboard_removed = True
         
-        # Отправляем афишу
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=poster["file_id"],
-            caption=caption,
-            reply_markup=InlineKeyboardMarkup(all_buttons)
-        )
+        # Если меню открыто с фото-афиши - меняем фото на месте, иначе отправляем новое
+        markup = InlineKeyboardMarkup(all_buttons)
+        edited = False
+        old_msg = edit_from.message if edit_from is not None else None
+        if old_msg is not None and old_msg.photo:
+            try:
+                await edit_from.edit_message_media(
+                    InputMediaPhoto(poster["file_id"], caption=caption),
+                    reply_markup=markup,
+                )
+                edited = True
+            except BadRequest as e:
+                edited = _is_not_modified(e)
+                if not edited:
+                    logger.debug("Cannot edit poster message, sending a new one: %s", e)
+        if not edited:
+            if old_msg is not None:
+                await safe_delete(old_msg)
+            await context.bot.send_photo(
+                chat_id=update.effective_chat.id,
+                photo=poster["file_id"],
+                caption=caption,
+                reply_markup=markup
+            )
         
         # Удаляем сообщение "Главное меню" чтобы не дублировать
-        try:
-            await keyboard_remove_msg.delete()
-        except:
-            pass  # Игнорируем ошибки удаления
+        if keyboard_remove_msg:
+            await safe_delete(keyboard_remove_msg)
             
     except Exception as e:
         logger.exception("Failed to send poster: %s", e)
@@ -748,452 +1334,434 @@ async def show_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.effective_chat.send_message(f"Ваш ID: {user.id}")
 
 
-async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    try:
-        await query.answer()
-        user = query.from_user
-        data = query.data
-        
-        # Автообновление username в фоне
-        await auto_update_username(update, context)
-        
-        logger.info("Button pressed by user %s: %s", user.id, data)
+# ----------------------
+# Callback handlers
+# ----------------------
 
-        # Загружаем данные пользователя из БД
-        await load_user_data_from_db(context, user.id)
+async def _cb_check_all(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    user = query.from_user
+    vk_id = st.vk_id
+    # Telegram и VK проверяем параллельно
+    (tg1_ok, tg2_ok), vk_status = await asyncio.gather(
+        is_user_subscribed(context, user.id),
+        is_user_subscribed_vk(vk_id) if (VK_ENABLED and vk_id) else asyncio.sleep(0, result=None),
+    )
+    
+    # VK со ссылкой и статусом
+    if not VK_ENABLED:
+        vk_line = ""
+    elif not vk_id:
+        vk_line = f"\n⚠️ [VK группа]({VK_GROUP_URL}) - профиль не привязан"
+    elif vk_status is None:
+        vk_line = f"\n❓ [VK группа]({VK_GROUP_URL}) - не удалось проверить"
+    elif vk_status:
+        vk_line = f"\n✅ [VK группа]({VK_GROUP_URL})"
+    else:
+        vk_line = f"\n❌ [VK группа]({VK_GROUP_URL}) - не подписан"
+    
+    # Итоговый статус - нужны все подписки
+    all_ok = tg1_ok and tg2_ok and (not VK_ENABLED or not vk_id or vk_status)
+    
+    # Формируем сообщение с простым форматом
+    text = (
+        "🔍 **Статус подписок:**\n\n"
+        f"{'✅' if tg1_ok else '❌'} [Largent MSK]({TG1_URL})\n"
+        f"{'✅' if tg2_ok else '❌'} [IDN Records]({TG2_URL})"
+        f"{vk_line}\n\n"
+        f"{'🎉 **Все проверки пройдены!**' if all_ok else '⚠️ **Требуется подписка для участия**'}"
+    )
+    
+    # Кнопки действий
+    btns = []
+    
+    # Кнопки подписки на каналы (если не подписан)
+    if not tg1_ok:
+        btns.append([InlineKeyboardButton("📢 Подписаться на Largent MSK", url=TG1_URL)])
+    if not tg2_ok:
+        btns.append([InlineKeyboardButton("🎵 Подписаться на IDN Records", url=TG2_URL)])
+    
+    # VK привязка - всегда показываем
+    if VK_ENABLED:
+        if not vk_id:
+            btns.append([InlineKeyboardButton("🔗 Привязать VK профиль", callback_data="link_vk")])
+        else:
+            btns.append([InlineKeyboardButton("🔄 Перепривязать VK", callback_data="link_vk")])
+    
+    btns.append([InlineKeyboardButton("🔄 Перепроверить", callback_data="check_all")])
+    btns.append([InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")])
+    
+    await replace_query_message(update, query, text, InlineKeyboardMarkup(btns), parse_mode="Markdown")
 
-        if data == "check_all":
-            tg1_ok, tg2_ok = await is_user_subscribed(context, user.id)
-            vk_id = context.user_data.get("vk_id")
-            vk_status = None
-            if VK_ENABLED and vk_id:
-                vk_status = await is_user_subscribed_vk(vk_id)
 
-            # Формируем сообщение с простым форматом
-            lines = ["🔍 **Статус подписок:**\n"]
-            
-            # Первый Telegram канал
-            tg1_icon = "✅" if tg1_ok else "❌"
-            tg1_url = f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}"
-            lines.append(f"{tg1_icon} [Largent MSK]({tg1_url})")
-            
-            # Второй Telegram канал
-            tg2_icon = "✅" if tg2_ok else "❌"
-            tg2_url = f"https://t.me/{CHANNEL_USERNAME_2.lstrip('@')}"
-            lines.append(f"{tg2_icon} [IDN Records]({tg2_url})")
-            
-            # VK со ссылкой и статусом
-            if VK_ENABLED:
-                if not vk_id:
-                    lines.append(f"⚠️ [VK группа](https://vk.com/{VK_GROUP_DOMAIN}) - профиль не привязан")
-                elif vk_status is None:
-                    lines.append(f"❓ [VK группа](https://vk.com/{VK_GROUP_DOMAIN}) - не удалось проверить")
-                elif vk_status is True:
-                    lines.append(f"✅ [VK группа](https://vk.com/{VK_GROUP_DOMAIN})")
-                elif vk_status is False:
-                    lines.append(f"❌ [VK группа](https://vk.com/{VK_GROUP_DOMAIN}) - не подписан")
-            
-            # Итоговый статус - нужны все подписки
-            all_tg_ok = tg1_ok and tg2_ok
-            if all_tg_ok and (not VK_ENABLED or not vk_id or vk_status):
-                lines.append("\n🎉 **Все проверки пройдены!**")
-            else:
-                lines.append("\n⚠️ **Требуется подписка для участия**")
-            
-            text = "\n".join(lines)
-            
-            # Кнопки действий
-            btns = []
-            
-            # Кнопки подписки на каналы (если не подписан)
-            if not tg1_ok:
-                btns.append([InlineKeyboardButton("📢 Подписаться на Largent MSK", url=tg1_url)])
-            if not tg2_ok:
-                btns.append([InlineKeyboardButton("🎵 Подписаться на IDN Records", url=tg2_url)])
-            
-            # VK привязка - всегда показываем
-            if VK_ENABLED:
-                if not vk_id:
-                    btns.append([InlineKeyboardButton("🔗 Привязать VK профиль", callback_data="link_vk")])
-                else:
-                    btns.append([InlineKeyboardButton("🔄 Перепривязать VK", callback_data="link_vk")])
-            
-            btns.append([InlineKeyboardButton("🔄 Перепроверить", callback_data="check_all")])
-            btns.append([InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")])
-            
-            # Удаляем старое сообщение и отправляем новое
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id, 
-                text=text, 
-                reply_markup=InlineKeyboardMarkup(btns), 
-                parse_mode="Markdown"
-            )
+async def _cb_link_vk(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    user = query.from_user
+    # Запрашиваем VK ID для привязки
+    logger.info("User %s clicked link_vk button", user.id)
+    try:
+        st.awaiting_vk = True
+        kb = _CANCEL_TO_MENU_KB
+    
+        # Проверяем есть ли уже привязанный VK
+        current_vk = st.vk_id
+        if current_vk:
+            text = _VK_LINK_TEXT_RELINK_TMPL.format(current_vk=current_vk)
+        else:
+            text = _VK_LINK_TEXT_NEW
+    
+        await replace_query_message(update, query, text, kb)
+        logger.info("Successfully showed VK link form to user %s", user.id)
+    except Exception as e:
+        logger.error("Failed to show VK link form to user %s: %s", user.id, e)
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="❌ Произошла ошибка при открытии формы привязки VK.\n\n"
+                 "Попробуйте еще раз или обратитесь к администратору.",
+            reply_markup=_MAIN_MENU_KB
+        )
 
-        elif data == "link_vk":
-            # Запрашиваем VK ID для привязки
-            logger.info("User %s clicked link_vk button", user.id)
-            try:
-                context.user_data["awaiting_vk"] = True
-                kb = [[InlineKeyboardButton("❌ Отмена", callback_data="back_to_menu")]]
-                
-                # Проверяем есть ли уже привязанный VK
-                current_vk = context.user_data.get("vk_id")
-                if current_vk:
-                    text = (
-                        "🔄 Перепривязка VK аккаунта\n\n"
-                        f"Текущий VK ID: {current_vk}\n\n"
-                        "Отправьте новый ID вашего VK аккаунта:\n\n"
-                        "Поддерживаемые форматы:\n"
-                        "• Цифры: 123456789\n"
-                        "• ID: id123456789\n"
-                        "• Никнейм: durov, ivan_petrov\n\n"
-                        "Как найти ID аккаунта:\n"
-                        "1. Откройте свой профиль VK\n"
-                        "2. Скопируйте из адресной строки:\n"
-                        "   • vk.com/durov → отправьте: durov\n"
-                        "   • vk.com/id123456789 → отправьте: 123456789\n\n"
-                        "⚠️ Убедитесь, что подписки в профиле открыты для просмотра"
-                    )
-                else:
-                    text = (
-                        "🔗 Привязка VK аккаунта\n\n"
-                        "Отправьте ID вашего VK аккаунта для проверки подписки:\n\n"
-                        "Поддерживаемые форматы:\n"
-                        "• Цифры: 123456789\n"
-                        "• ID: id123456789\n"
-                        "• Никнейм: durov, ivan_petrov\n\n"
-                        "Как найти ID аккаунта:\n"
-                        "1. Откройте свой профиль VK\n"
-                        "2. Скопируйте из адресной строки:\n"
-                        "   • vk.com/durov → отправьте: durov\n"
-                        "   • vk.com/id123456789 → отправьте: 123456789\n\n"
-                        "⚠️ Убедитесь, что подписки в профиле открыты для просмотра"
-                    )
-                
-                # Удаляем старое сообщение (афишу) и отправляем новое
-                try:
-                    await query.message.delete()
-                except Exception:
-                    pass
-                
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=text,
-                    reply_markup=InlineKeyboardMarkup(kb)
-                )
-                logger.info("Successfully showed VK link form to user %s", user.id)
-            except Exception as e:
-                logger.error("Failed to show VK link form to user %s: %s", user.id, e)
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="❌ Произошла ошибка при открытии формы привязки VK.\n\n"
-                         "Попробуйте еще раз или обратитесь к администратору.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")]])
-                )
-        
-        elif data == "show_current_poster":
-            # Показать актуальную афишу (последнюю)
-            all_posters = context.bot_data.get("all_posters", [])
-            if all_posters:
-                context.user_data["current_poster_index"] = len(all_posters) - 1
-            # UX: удаляем старое сообщение и отправляем новое фото афиши
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
-        
-        elif data == "poster":
-            # Показать актуальную афишу (последнюю) - для совместимости
-            all_posters = context.bot_data.get("all_posters", [])
-            if all_posters:
-                context.user_data["current_poster_index"] = len(all_posters) - 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
-        
-        elif data == "open_admin":
-            # Открыть админ-панель через callback
-            await admin_panel(update, context)
-        
-        elif data == "back_to_menu":
-            # Загружаем данные пользователя из БД перед показом меню
-            await load_user_data_from_db(context, user.id)
-            
-            # Сбрасываем индекс афиши на последнюю (самую новую)
-            all_posters = context.bot_data.get("all_posters", [])
-            if all_posters:
-                context.user_data["current_poster_index"] = len(all_posters) - 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
-        
-        elif data == "poster_prev":
-            # Переход к предыдущей афише
-            all_posters = context.bot_data.get("all_posters", [])
-            current_index = context.user_data.get("current_poster_index", len(all_posters) - 1 if all_posters else 0)
-            if current_index > 0:
-                context.user_data["current_poster_index"] = current_index - 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
-        
-        elif data.startswith("delete_poster:"):
-            try:
-                poster_index = int(data.split(":", 1)[1])
-                all_posters = context.bot_data.get("all_posters", [])
-                
-                if 0 <= poster_index < len(all_posters):
-                    deleted_poster = all_posters.pop(poster_index)
-                    context.bot_data["all_posters"] = all_posters
-                    
-                    # Если удаленная афиша была текущей, обновляем текущую
-                    current_poster = context.bot_data.get("poster")
-                    if current_poster == deleted_poster:
-                        if all_posters:
-                            context.bot_data["poster"] = all_posters[-1]
-                        else:
-                            context.bot_data.pop("poster", None)
-                    
-                    caption = deleted_poster.get("caption", "Без описания")
-                    if len(caption) > 50:
-                        caption = caption[:50] + "..."
-                    
-                    await query.edit_message_text(
-                        f"✅ Афиша удалена: {caption}\n\nОсталось афиш: {len(all_posters)}"
-                    )
-                else:
-                    await query.edit_message_text("❌ Неверный номер афиши")
-            except (ValueError, IndexError):
-                await query.edit_message_text("❌ Ошибка при удалении афиши")
-        
-        elif data == "cancel_delete":
-            await query.edit_message_text("❌ Удаление отменено")
-        
-        elif data == "poster_next":
-            # Переход к следующей афише
-            all_posters = context.bot_data.get("all_posters", [])
-            current_index = context.user_data.get("current_poster_index", len(all_posters) - 1 if all_posters else 0)
-            if current_index < len(all_posters) - 1:
-                context.user_data["current_poster_index"] = current_index + 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
-        
-        elif data.startswith("gender_"):
-            # Обработка выбора пола
-            gender = data.split("_", 1)[1]
-            context.user_data["gender"] = gender
-            context.user_data["registration_step"] = "age"
-            
-            # Сохраняем пол в БД
-            pool = get_db_pool(context)
-            if pool:
-                try:
-                    await upsert_user(pool, tg_id=user.id, gender=gender, username=user.username)
-                    logger.info("Gender saved to DB for user %s: %s", user.id, gender)
-                except Exception as e:
-                    logger.warning("Failed to save gender to DB: %s", e)
-            
-            gender_text = {
-                "male": "мужской",
-                "female": "женский"
-            }.get(gender, "")
-            
+
+async def _cb_show_current_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Показать актуальную афишу (последнюю); None - show_main_menu возьмёт последнюю
+    st.current_poster_index = None
+    await show_main_menu(update, context, edit_from=query)
+
+
+async def _cb_open_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Открыть админ-панель через callback
+    await admin_panel(update, context)
+
+
+async def _cb_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Сбрасываем индекс афиши на последнюю (самую новую).
+    # Данные пользователя из БД уже подгрузил handle_buttons.
+    st.current_poster_index = None
+    await show_main_menu(update, context, edit_from=query)
+
+
+async def _step_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState, delta: int) -> None:
+    """Сдвинуть карусель афиш; фото в сообщении меняется через edit_message_media"""
+    last = len(get_all_posters(context)) - 1
+    current_index = st.current_poster_index
+    if current_index is None or current_index > last:
+        current_index = last
+    st.current_poster_index = min(max(current_index + delta, 0), max(last, 0))
+    await show_main_menu(update, context, edit_from=query)
+
+
+async def _cb_poster_prev(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    await _step_poster(update, context, query, st, -1)
+
+
+async def _cb_delete_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    user = query.from_user
+    data = query.data
+    if not is_admin(context, user.id):
+        return
+    try:
+        kind, value = data.split(":", 1)
+        if kind == "delete_poster_id":
+            poster_index = find_poster_index(int(value))
+        else:
+            poster_index = int(value)
+        all_posters = get_all_posters(context)
+    
+        if 0 <= poster_index < len(all_posters):
+            deleted_poster = await remove_poster(context, poster_index)
+    
+            caption = deleted_poster.get("caption", "Без описания")
+            if len(caption) > 50:
+                caption = caption[:50] + "..."
+    
             await query.edit_message_text(
-                f"Пол: {gender_text} ✅\n\n"
-                "Теперь укажите ваш возраст (только число)\n"
-                "Например: 18"
+                f"✅ Афиша удалена: {caption}\n\nОсталось афиш: {len(all_posters)}"
             )
+        else:
+            await query.edit_message_text("❌ Неверный номер афиши")
+    except (ValueError, IndexError):
+        await query.edit_message_text("❌ Ошибка при удалении афиши")
+
+
+async def _cb_cancel_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    await query.edit_message_text("❌ Удаление отменено")
+
+
+async def _cb_poster_next(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    await _step_poster(update, context, query, st, 1)
+
+
+async def _cb_gender(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    data = query.data
+    # Обработка выбора пола
+    gender = data.split("_", 1)[1]
+    st.gender = gender
+    st.registration_step = "age"
+    # В БД пол попадёт одной записью вместе с возрастом в конце регистрации
+    
+    gender_text = _GENDER_TEXT.get(gender, "")
+    
+    await query.edit_message_text(
+        f"Пол: {gender_text} ✅\n\n"
+        "Теперь укажите ваш возраст (только число)\n"
+        "Например: 18"
+    )
+
+
+async def _cb_past_event(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Уведомление о прошедшем мероприятии
+    await query.answer("Это мероприятие уже прошло 📅")
+
+
+async def _admin_create_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # init draft
+    st.poster_draft = PosterDraft()
+    await query.edit_message_text(
+        "Шаг 1/4: пришлите фото афиши",
+        reply_markup=_POSTER_STEP_KB,
+    )
+
+
+async def _admin_broadcast_now(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    await do_weekly_broadcast(context)
+    await query.edit_message_text("Афиша отправлена всем ✅")
+
+
+async def _admin_set_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    st.awaiting_ticket = True
+    await query.edit_message_text("Пришлите ссылку для кнопки «Купить билет»")
+
+
+async def _admin_delete_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Удаляем текущую (последнюю) афишу
+    all_posters = get_all_posters(context)
+    if all_posters:
+        await remove_poster(context, -1)
+    
+        if all_posters:
+            await query.edit_message_text(f"Афиша удалена ✅\n\nОсталось афиш: {len(all_posters)}")
+        else:
+            await query.edit_message_text("Афиша удалена ✅\n\nАфиш больше нет.")
+    else:
+        await query.edit_message_text("Нет афиши для удаления ❌")
+
+
+async def _admin_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    st.awaiting_broadcast_text = True
+    await query.edit_message_text("Пришлите текст рассылки одним сообщением")
+
+
+async def _admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    count = len(get_known_users(context))
+    text = f"Пользователей: {count}"
+    pool = get_db_pool(context)
+    if pool:
+        text += f"\nСоединений с БД: {pool.get_size()} (свободно {pool.get_idle_size()}, максимум {pool.get_max_size()})"
+    await query.edit_message_text(text)
+
+
+async def _admin_back_to_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    st.poster_draft = None
+    await admin_panel(update, context)
+
+
+async def _admin_confirm_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    draft = st.poster_draft or PosterDraft()
+    # Validate poster before saving
+    if not draft.file_id:
+        await query.edit_message_text("❌ Не загружено фото афиши. Начните заново.")
+        return
+    caption_ok = is_valid_caption(draft.caption or "")
+    link_ok = (not draft.ticket_url) or is_valid_url(draft.ticket_url)
+    if not caption_ok:
+        await query.edit_message_text("❌ Слишком длинная подпись. Максимум 1024 символа.")
+        return
+    if not link_ok:
+        await query.edit_message_text("❌ Некорректная ссылка на билеты. Укажите URL формата https://...")
+        return
+    
+    # Сохраняем афишу - она становится актуальной (последней)
+    poster = await add_poster(context, draft.file_id, draft.caption or "", draft.ticket_url)
+    all_posters = get_all_posters(context)
+    
+    st.poster_draft = None
+    # Опубликовать в чат админу одним сообщением (фото+текст+кнопка)
+    rm = None
+    if poster.get("ticket_url"):
+        rm = InlineKeyboardMarkup([[InlineKeyboardButton("Купить билет", url=poster["ticket_url"])]])
+    await context.bot.send_photo(
+        chat_id=query.message.chat_id, 
+        photo=poster["file_id"], 
+        caption=poster.get("caption", ""), 
+        reply_markup=rm
+    )
+    await query.edit_message_text(f"Афиша сохранена и опубликована ✅\n\nВсего афиш: {len(all_posters)}")
+
+
+async def _admin_cancel_poster(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    st.poster_draft = None
+    await query.edit_message_text("Создание афиши отменено ❌")
+
+
+async def _admin_users_count(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Показать количество пользователей
+    pool = get_db_pool(context)
+    if pool:
+        try:
+            stats = await get_cached_user_stats(pool)
+            text = "\n".join((
+                "👥 <b>Статистика пользователей</b>",
+                "",
+                f"• Всего пользователей: {stats.get('total_users', 0)}",
+                f"• С привязанным VK: {stats.get('users_with_vk', 0)}",
+                f"• Мужчин: {stats.get('male_users', 0)}",
+                f"• Женщин: {stats.get('female_users', 0)}",
+                f"• Зарегистрировано сегодня: {stats.get('today_registrations', 0)}",
+            ))
+        except Exception as e:
+            text = f"❌ Ошибка получения статистики: {html.escape(str(e))}"
+    else:
+        text = f"👥 Пользователей в кеше: {len(get_known_users(context))}"
+    
+    kb = _BACK_TO_PANEL_KB
+    await query.edit_message_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+
+
+def render_posters_list(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Текст списка афиш для админки (собирается заново только после изменений)"""
+    global _posters_list_text
+    if _posters_list_text is not None:
+        return _posters_list_text
+
+    all_posters = get_all_posters(context)
+    if not all_posters:
+        text = "📋 Список афиш пуст"
+    else:
+        parts = [f"📋 <b>Список всех афиш ({len(all_posters)}):</b>\n\n"]
+        current_poster = get_latest_poster(context)
+    
+        for i, poster in enumerate(all_posters):
+            caption = poster.get("caption", "Без описания")
+            if len(caption) > 40:
+                caption = caption[:40] + "..."
+    
+            status = "🟢 ТЕКУЩАЯ" if poster is current_poster else "⚪"
+            ticket_status = "🎫" if poster.get("ticket_url") else "❌"
+    
+            parts.append(f"{i+1}. {status} {html.escape(caption)}\n   Билеты: {ticket_status}\n\n")
+        text = "".join(parts)
+    _posters_list_text = text
+    return text
+
+
+async def _admin_list_posters(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Показать список всех афиш
+    text = render_posters_list(context)
+    kb = _BACK_TO_PANEL_KB
+    try:
+        await query.edit_message_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        if not _is_not_modified(e):
+            raise
+
+
+async def _admin_check_by_username(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Проверка подписки по username/ID в режиме непрерывной проверки
+    st.awaiting_username_check = True
+    st.continuous_check_mode = True
+    kb = _STOP_CHECK_KB
+    await query.edit_message_text(
+        "🔍 **Режим массовой проверки активирован**\n\n"
+        "Отправьте username (с @) или Telegram ID пользователя:\n\n"
+        "**Примеры:**\n"
+        "• Username: `@durov`\n"
+        "• ID: `123456789`\n\n"
+        "💡 После проверки сразу можно вводить следующий username\n"
+        "Нажмите '🔙 Завершить проверку' для выхода",
+        reply_markup=kb,
+        parse_mode="Markdown"
+    )
+
+
+async def _admin_stop_check(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Завершение режима непрерывной проверки
+    st.awaiting_username_check = False
+    st.continuous_check_mode = False
+    await query.edit_message_text("✅ Режим проверки завершен")
+    await admin_panel(update, context)
+
+
+async def _admin_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE, query: CallbackQuery, st: UserState) -> None:
+    # Обновить админ-панель
+    await admin_panel(update, context)
+
+
+# Точные значения callback_data -> обработчик
+_CALLBACK_HANDLERS = {
+    "check_all": _cb_check_all,
+    "link_vk": _cb_link_vk,
+    "show_current_poster": _cb_show_current_poster,
+    "poster": _cb_show_current_poster,  # старое имя кнопки
+    "open_admin": _cb_open_admin,
+    "back_to_menu": _cb_back_to_menu,
+    "poster_prev": _cb_poster_prev,
+    "cancel_delete": _cb_cancel_delete,
+    "poster_next": _cb_poster_next,
+    "past_event": _cb_past_event,
+}
+# Параметризованные callback_data: (префикс, обработчик)
+_CALLBACK_PREFIXES = (
+    ("delete_poster:", _cb_delete_poster),
+    ("delete_poster_id:", _cb_delete_poster),
+    ("gender_", _cb_gender),
+)
+# Подкоманды admin:<sub>
+_ADMIN_CALLBACKS = {
+    "create_poster": _admin_create_poster,
+    "broadcast_now": _admin_broadcast_now,
+    "set_ticket": _admin_set_ticket,
+    "delete_poster": _admin_delete_poster,
+    "broadcast_text": _admin_broadcast_text,
+    "stats": _admin_stats,
+    "back_to_panel": _admin_back_to_panel,
+    "confirm_poster": _admin_confirm_poster,
+    "cancel_poster": _admin_cancel_poster,
+    "users_count": _admin_users_count,
+    "list_posters": _admin_list_posters,
+    "check_by_username": _admin_check_by_username,
+    "stop_check": _admin_stop_check,
+    "refresh": _admin_refresh,
+}
+
+
+async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    try:
+        await query.answer()
+        user = query.from_user
+        data = query.data
         
-        elif data == "past_event":
-            # Уведомление о прошедшем мероприятии
-            await query.answer("Это мероприятие уже прошло 📅")
+        # Автообновление username в фоне
+        context.application.create_task(auto_update_username(update, context), update=update)
         
-        elif data.startswith("admin:"):
-            sub = data.split(":", 1)[1]
-            if user.id not in get_admins(context):
-                await query.edit_message_text("Недостаточно прав.")
-                return
-            
-            if sub == "create_poster":
-                # init draft
-                ud = context.user_data
-                ud["poster_draft"] = {"step": "photo", "file_id": None, "caption": None, "ticket_url": None}
-                await query.edit_message_text(
-                    "Шаг 1/4: пришлите фото афиши",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")],
-                        [InlineKeyboardButton("❌ Отмена", callback_data="admin:cancel_poster")],
-                    ]),
-                )
-            
-            elif sub == "broadcast_now":
-                await do_weekly_broadcast(context)
-                await query.edit_message_text("Афиша отправлена всем ✅")
-            
-            elif sub == "set_ticket":
-                context.user_data["awaiting_ticket"] = True
-                await query.edit_message_text("Пришлите ссылку для кнопки «Купить билет»")
-            
-            elif sub == "delete_poster":
-                # Удаляем текущую афишу
-                current_poster = context.bot_data.pop("poster", None)
-                if current_poster:
-                    # Удаляем из списка всех афиш
-                    all_posters = context.bot_data.get("all_posters", [])
-                    if current_poster in all_posters:
-                        all_posters.remove(current_poster)
-                        context.bot_data["all_posters"] = all_posters
-                    
-                    # Если есть другие афиши, делаем последнюю текущей
-                    if all_posters:
-                        context.bot_data["poster"] = all_posters[-1]
-                        await query.edit_message_text(f"Афиша удалена ✅\n\nОсталось афиш: {len(all_posters)}")
-                    else:
-                        await query.edit_message_text("Афиша удалена ✅\n\nАфиш больше нет.")
-                else:
-                    await query.edit_message_text("Нет афиши для удаления ❌")
-            
-            elif sub == "broadcast_text":
-                context.user_data["awaiting_broadcast_text"] = True
-                await query.edit_message_text("Пришлите текст рассылки одним сообщением")
-            
-            elif sub == "stats":
-                count = len(get_known_users(context))
-                await query.edit_message_text(f"Пользователей: {count}")
-            
-            elif sub == "back_to_panel":
-                context.user_data.pop("poster_draft", None)
-                await admin_panel(update, context)
-            
-            elif sub == "confirm_poster":
-                draft = context.user_data.get("poster_draft") or {}
-                # Validate poster before saving
-                if not draft.get("file_id"):
-                    await query.edit_message_text("❌ Не загружено фото афиши. Начните заново.")
-                    return
-                caption_ok = is_valid_caption(draft.get("caption") or "")
-                link_ok = (not draft.get("ticket_url")) or is_valid_url(draft.get("ticket_url"))
-                if not caption_ok:
-                    await query.edit_message_text("❌ Слишком длинная подпись. Максимум 1024 символа.")
-                    return
-                if not link_ok:
-                    await query.edit_message_text("❌ Некорректная ссылка на билеты. Укажите URL формата https://...")
+        logger.info("Button pressed by user %s: %s", user.id, data)
+
+        # Загружаем данные пользователя из БД
+        await load_user_data_from_db(context, user.id)
+        st = get_user_state(context)
+
+        handler = _CALLBACK_HANDLERS.get(data)
+        if handler is None:
+            if data.startswith("admin:"):
+                if not is_admin(context, user.id):
+                    await query.edit_message_text("Недостаточно прав.")
                     return
-                
-                poster = {"file_id": draft["file_id"], "caption": draft.get("caption") or "", "ticket_url": draft.get("ticket_url")}
-                context.bot_data["poster"] = poster
-                
-                # Добавляем афишу в список всех афиш
-                all_posters = context.bot_data.get("all_posters", [])
-                all_posters.append(poster)
-                context.bot_data["all_posters"] = all_posters
-                
-                context.user_data.pop("poster_draft", None)
-                # Опубликовать в чат админу одним сообщением (фото+текст+кнопка)
-                rm = None
-                if poster.get("ticket_url"):
-                    rm = InlineKeyboardMarkup([[InlineKeyboardButton("Купить билет", url=poster["ticket_url"])]])
-                await context.bot.send_photo(
-                    chat_id=query.message.chat_id, 
-                    photo=poster["file_id"], 
-                    caption=poster.get("caption", ""), 
-                    reply_markup=rm
-                )
-                await query.edit_message_text(f"Афиша сохранена и опубликована ✅\n\nВсего афиш: {len(all_posters)}")
-            
-            elif sub == "cancel_poster":
-                context.user_data.pop("poster_draft", None)
-                await query.edit_message_text("Создание афиши отменено ❌")
-            
-            elif sub == "users_count":
-                # Показать количество пользователей
-                pool = get_db_pool(context)
-                if pool:
-                    try:
-                        stats = await get_user_stats(pool)
-                        text = f"👥 **Статистика пользователей**\n\n"
-                        text += f"• Всего пользователей: {stats.get('total_users', 0)}\n"
-                        text += f"• С привязанным VK: {stats.get('users_with_vk', 0)}\n"
-                        text += f"• Мужчин: {stats.get('male_users', 0)}\n"
-                        text += f"• Женщин: {stats.get('female_users', 0)}\n"
-                        text += f"• Зарегистрировано сегодня: {stats.get('today_registrations', 0)}"
-                    except Exception as e:
-                        text = f"❌ Ошибка получения статистики: {e}"
-                else:
-                    text = f"👥 Пользователей в кеше: {len(get_known_users(context))}"
-                
-                kb = [[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]]
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
-            
-            elif sub == "list_posters":
-                # Показать список всех афиш
-                all_posters = context.bot_data.get("all_posters", [])
-                if not all_posters:
-                    text = "📋 Список афиш пуст"
-                else:
-                    text = f"📋 **Список всех афиш ({len(all_posters)}):**\n\n"
-                    current_poster = context.bot_data.get("poster")
-                    
-                    for i, poster in enumerate(all_posters):
-                        caption = poster.get("caption", "Без описания")
-                        if len(caption) > 40:
-                            caption = caption[:40] + "..."
-                        
-                        status = "🟢 ТЕКУЩАЯ" if poster == current_poster else "⚪"
-                        ticket_status = "🎫" if poster.get("ticket_url") else "❌"
-                        
-                        text += f"{i+1}. {status} {caption}\n   Билеты: {ticket_status}\n\n"
-                
-                kb = [[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]]
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
-            
-            elif sub == "check_by_username":
-                # Проверка подписки по username/ID в режиме непрерывной проверки
-                context.user_data["awaiting_username_check"] = True
-                context.user_data["continuous_check_mode"] = True
-                kb = [[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]]
-                await query.edit_message_text(
-                    "🔍 **Режим массовой проверки активирован**\n\n"
-                    "Отправьте username (с @) или Telegram ID пользователя:\n\n"
-                    "**Примеры:**\n"
-                    "• Username: `@durov`\n"
-                    "• ID: `123456789`\n\n"
-                    "💡 После проверки сразу можно вводить следующий username\n"
-                    "Нажмите '🔙 Завершить проверку' для выхода",
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode="Markdown"
-                )
-            
-            elif sub == "stop_check":
-                # Завершение режима непрерывной проверки
-                context.user_data["awaiting_username_check"] = False
-                context.user_data["continuous_check_mode"] = False
-                await query.edit_message_text(
-                    "✅ Режим проверки завершен\n\n"
-                    "Возвращение в админ-панель...",
-                    parse_mode="Markdown"
-                )
-                await asyncio.sleep(1)
-                await admin_panel(update, context)
-            
-            elif sub == "refresh":
-                # Обновить админ-панель
-                await admin_panel(update, context)
+                handler = _ADMIN_CALLBACKS.get(data.split(":", 1)[1])
+            else:
+                for prefix, prefix_handler in _CALLBACK_PREFIXES:
+                    if data.startswith(prefix):
+                        handler = prefix_handler
+                        break
+        if handler is not None:
+            await handler(update, context, query, st)
     
     except Exception as e:
         logger.exception("handle_buttons failed: %s", e)
@@ -1204,7 +1772,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def send_poster_to_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
-    all_posters = context.bot_data.get("all_posters", [])
+    all_posters = get_all_posters(context)
     if not all_posters:
         await context.bot.send_message(chat_id, "Афиш пока нет ;(")
         return
@@ -1222,6 +1790,7 @@ async def send_poster_to_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int)
         await context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup)
     except Forbidden:
         logger.info("Cannot send message to chat_id %s (blocked or privacy)", chat_id)
+        await mark_user_blocked(context, chat_id)
     except Exception as e:
         logger.exception("Failed to send poster to %s: %s", chat_id, e)
 
@@ -1232,7 +1801,7 @@ async def send_poster_to_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int)
 
 async def admin_only(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
-    return bool(user and (user.id in get_admins(context)))
+    return bool(user and is_admin(context, user.id))
 
 
 async def save_poster(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1248,10 +1817,10 @@ async def save_poster(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     largest = photo_msg.photo[-1]
     file_id = largest.file_id
-    caption = photo_msg.caption or ""
-    poster = context.bot_data.get("poster", {})
+    caption = clean_caption(photo_msg.caption or "")
+    poster = get_latest_poster(context) or {}
     ticket_url = poster.get("ticket_url")
-    context.bot_data["poster"] = {"file_id": file_id, "caption": caption, "ticket_url": ticket_url}
+    await add_poster(context, file_id, caption, ticket_url)
     await msg.reply_text("Афиша сохранена ✅ (фото и подпись). Для ссылки используйте /set_ticket <url>")
 
 
@@ -1265,26 +1834,27 @@ async def set_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await msg.reply_text("Укажи ссылку: /set_ticket https://...")
         return
     url = context.args[0].strip()
-    poster = context.bot_data.get("poster") or {}
-    poster["ticket_url"] = url
-    context.bot_data["poster"] = poster
+    if not await set_latest_ticket_url(context, url):
+        await msg.reply_text("Нет афиши для ссылки ❌")
+        return
     await msg.reply_text("Ссылка на покупку билета сохранена ✅")
 
 
 async def delete_poster(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await admin_only(update, context):
         return
-    context.bot_data.pop("poster", None)
+    if get_all_posters(context):
+        await remove_poster(context, -1)
     await update.message.reply_text("Афиша удалена. Загрузите новую с /save_poster")
 
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отобразить улучшенную админ-панель с inline кнопками."""
     user = update.effective_user
-    admins = get_admins(context)
-    if not admins and user:
-        admins.add(user.id)
-    if not user or user.id not in admins:
+    if user and not CONFIG.admin_ids and not context.bot_data.get("admins"):
+        # Первый вызвавший /admin становится админом, если никто не назначен
+        get_dynamic_admins(context).add(user.id)
+    if not user or not is_admin(context, user.id):
         await update.effective_chat.send_message("Эта команда доступна только администратору.")
         return
     
@@ -1293,78 +1863,52 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     stats = {}
     if pool:
         try:
-            stats = await get_user_stats(pool)
+            stats = await get_cached_user_stats(pool)
         except Exception as e:
             logger.warning("Failed to get stats: %s", e)
     
     # Показать информацию об афишах и пользователях
-    all_posters = context.bot_data.get("all_posters", [])
-    current_poster = context.bot_data.get("poster")
+    all_posters = get_all_posters(context)
+    current_poster = get_latest_poster(context)
     
-    status_text = "🛠 **Админ-панель TusaBot**\n\n"
+    lines = ["🛠 <b>Админ-панель TusaBot</b>", ""]
     
     # Статистика афиш
-    status_text += "📊 **Афиши:**\n"
-    status_text += f"• Всего афиш: {len(all_posters)}\n"
+    lines.append("📊 <b>Афиши:</b>")
+    lines.append(f"• Всего афиш: {len(all_posters)}")
     if current_poster:
-        status_text += "• Текущая афиша: ✅ есть\n"
+        lines.append("• Текущая афиша: ✅ есть")
         if current_poster.get("ticket_url"):
-            status_text += "• Ссылка на билеты: ✅ есть\n"
+            lines.append("• Ссылка на билеты: ✅ есть")
         else:
-            status_text += "• Ссылка на билеты: ❌ нет\n"
+            lines.append("• Ссылка на билеты: ❌ нет")
     else:
-        status_text += "• Текущая афиша: ❌ нет\n"
+        lines.append("• Текущая афиша: ❌ нет")
     
     # Статистика пользователей из БД
-    status_text += "\n👥 **Пользователи:**\n"
+    lines.append("")
+    lines.append("👥 <b>Пользователи:</b>")
     if stats:
-        status_text += f"• Всего: {stats.get('total_users', 0)}\n"
-        status_text += f"• С VK: {stats.get('users_with_vk', 0)}\n"
-        status_text += f"• Мужчин: {stats.get('male_users', 0)}\n"
-        status_text += f"• Женщин: {stats.get('female_users', 0)}\n"
-        status_text += f"• Сегодня: {stats.get('today_registrations', 0)}\n"
+        lines.append(f"• Всего: {stats.get('total_users', 0)}")
+        lines.append(f"• С VK: {stats.get('users_with_vk', 0)}")
+        lines.append(f"• Мужчин: {stats.get('male_users', 0)}")
+        lines.append(f"• Женщин: {stats.get('female_users', 0)}")
+        lines.append(f"• Сегодня: {stats.get('today_registrations', 0)}")
     else:
-        status_text += f"• Всего: {len(get_known_users(context))}\n"
-    
-    # Inline кнопки для удобства
-    admin_buttons = [
-        # Управление афишами
-        [
-            InlineKeyboardButton("🧩 Создать афишу", callback_data="admin:create_poster"),
-            InlineKeyboardButton("📋 Список афиш", callback_data="admin:list_posters")
-        ],
-        [
-            InlineKeyboardButton("📤 Разослать афишу", callback_data="admin:broadcast_now"),
-            InlineKeyboardButton("🗑 Удалить афишу", callback_data="admin:delete_poster")
-        ],
-        # Настройки и рассылки
-        [
-            InlineKeyboardButton("🔗 Задать ссылку", callback_data="admin:set_ticket"),
-            InlineKeyboardButton("📝 Текстовая рассылка", callback_data="admin:broadcast_text")
-        ],
-        # Пользователи
-        [
-            InlineKeyboardButton("🔍 Проверка по нику", callback_data="admin:check_by_username"),
-            InlineKeyboardButton("🔄 Обновить", callback_data="admin:refresh")
-        ],
-        [
-            InlineKeyboardButton("👥 Пользователи", callback_data="admin:users_count")
-        ],
-        # Выход
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")]
-    ]
+        lines.append(f"• Всего: {len(get_known_users(context))}")
+    status_text = "\n".join(lines)
     
     await update.effective_chat.send_message(
         status_text, 
-        reply_markup=InlineKeyboardMarkup(admin_buttons),
-        parse_mode="Markdown"
+        reply_markup=_ADMIN_KB,
+        parse_mode=ParseMode.HTML
     )
 
 
 async def make_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Добавить администратора: /make_admin <user_id> или в ответ на сообщ. пользователя."""
     user = update.effective_user
-    if not user or user.id not in get_admins(context):
+    if not user or not is_admin(context, user.id):
         await update.effective_chat.send_message("Эта команда доступна только администратору.")
         return
     target_id = None
@@ -1375,8 +1919,7 @@ async def make_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if not target_id:
         await update.effective_chat.send_message("Укажи ID: /make_admin <user_id> или ответь на его сообщение.")
         return
-    admins = get_admins(context)
-    admins.add(target_id)
+    get_dynamic_admins(context).add(target_id)
     await update.effective_chat.send_message(f"Пользователь {target_id} добавлен в администраторы ✅")
 
 
@@ -1387,6 +1930,67 @@ async def broadcast_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_text("Разослал текущую афишу всем известным пользователям ✅")
 
 
+BROADCAST_CONCURRENCY = 25  # одновременных отправок при рассылке
+BROADCAST_BATCH = 500  # сколько отправок создаём за раз, чтобы не держать N корутин
+
+
+async def broadcast(
+    context: ContextTypes.DEFAULT_TYPE,
+    user_ids: Sequence[int],
+    send: Callable[[int], Awaitable[Any]],
+) -> int:
+    """Вызвать send(uid) для всех пользователей параллельно; вернуть число успешных
+
+    Темп отправки и повторы после 429 целиком на AIORateLimiter приложения:
+    RetryAfter, дошедший сюда, значит, что повторы исчерпаны, - считаем
+    отправку неудачной. Заблокировавших бота убираем из рассылок.
+    """
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def _send_one(uid: int) -> bool:
+        async with sem:
+            try:
+                await send(uid)
+                return True
+            except RetryAfter:
+                logger.warning("Broadcast to %s still flood-limited after retries, skipping", uid)
+            except Forbidden:
+                logger.info("Cannot message user %s (blocked)", uid)
+                await mark_user_blocked(context, uid)
+            except Exception as e:
+                logger.warning("Broadcast failed to %s: %s", uid, e)
+            return False
+
+    delivered = 0
+    for start in range(0, len(user_ids), BROADCAST_BATCH):
+        batch = user_ids[start:start + BROADCAST_BATCH]
+        delivered += sum(await asyncio.gather(*(_send_one(uid) for uid in batch)))
+    return delivered
+
+
+async def send_text_to_all(context: ContextTypes.DEFAULT_TYPE, text: str) -> int:
+    """Разослать текст всем известным пользователям; вернуть число доставленных"""
+    # Снимок множества: /start во время рассылки добавляет в него пользователей
+    return await broadcast(
+        context,
+        tuple(get_known_users(context)),
+        lambda uid: context.bot.send_message(uid, text),
+    )
+
+
+async def copy_to_all(context: ContextTypes.DEFAULT_TYPE, message: Message) -> int:
+    """Разослать копию сообщения всем известным пользователям; вернуть число доставленных
+
+    copy_message ссылается на уже отправленное сообщение, поэтому Telegram не
+    получает текст заново на каждого получателя, а форматирование сохраняется.
+    """
+    return await broadcast(
+        context,
+        tuple(get_known_users(context)),
+        lambda uid: context.bot.copy_message(uid, from_chat_id=message.chat_id, message_id=message.message_id),
+    )
+
+
 async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await admin_only(update, context):
         return
@@ -1394,13 +1998,7 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Формат: /broadcast_text ваш текст")
         return
     text = update.message.text.partition(' ')[2]
-    for uid in list(get_known_users(context)):
-        try:
-            await context.bot.send_message(uid, text)
-        except Forbidden:
-            logger.info("Cannot message user %s (blocked)", uid)
-        except Exception as e:
-            logger.warning("Broadcast text failed to %s: %s", uid, e)
+    await send_text_to_all(context, text)
 
 
 # ----------------------
@@ -1408,57 +2006,54 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ----------------------
 
 async def finalize_previous_week_and_reengage(context: ContextTypes.DEFAULT_TYPE) -> None:
+    pool = get_db_pool(context)
+    if not pool:
+        logger.warning("No DB pool, skipping weekly re-engage")
+        return
     now = datetime.now(timezone.utc)
     prev_key = previous_week_key(now)
 
-    for uid in list(get_known_users(context)):
-        ud = context.application.user_data.setdefault(uid, {})
-        attended_weeks: Set[str] = ud.get("attended_weeks", set())
-        missed_in_row = int(ud.get("missed_in_row", 0))
-        if prev_key in attended_weeks:
-            ud["missed_in_row"] = 0
-        else:
-            missed_in_row += 1
-            ud["missed_in_row"] = missed_in_row
-            if missed_in_row > 2:
-                try:
-                    await context.bot.send_message(uid, REENGAGE_TEXT)
-                except Forbidden:
-                    logger.info("Cannot message user %s (blocked)", uid)
-                except Exception as e:
-                    logger.warning("Re-engage send failed to %s: %s", uid, e)
-        context.application.user_data[uid] = ud
-
+    # Счётчики пропусков считает БД, сюда приходят только те, кому пора напомнить
+    for uid in await advance_missed_weeks(pool, prev_key):
+        try:
+            await context.bot.send_message(uid, REENGAGE_TEXT)
+        except Forbidden:
+            logger.info("Cannot message user %s (blocked)", uid)
+            await mark_user_blocked(context, uid)
+        except Exception as e:
+            logger.warning("Re-engage send failed to %s: %s", uid, e)
 
 async def do_weekly_broadcast(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Рассылка афиши всем пользователям бота в личные сообщения (БЕЗ публикации в VK)"""
-    known_users = get_known_users(context)
+    # Снимок множества: /start во время рассылки добавляет в него пользователей
+    known_users = tuple(get_known_users(context))
     if not known_users:
         logger.info("No users to broadcast to")
         return
     
-    # Получаем последнюю афишу для рассылки
-    all_posters = context.bot_data.get("all_posters", [])
-    if not all_posters:
+    # Рассылаем последнюю афишу
+    poster = get_latest_poster(context)
+    if not poster:
         logger.info("No posters to broadcast")
         return
     
-    latest_poster = all_posters[-1]
-    
     # Рассылка в Telegram (только в личные сообщения пользователям)
-    success_count = 0
-    for user_id in known_users:
-        try:
-            await send_poster_to_chat(context, user_id)
-            success_count += 1
-        except Exception as e:
-            logger.warning("Failed to send poster to user %s: %s", user_id, e)
+    reply_markup = None
+    if poster.get("ticket_url"):
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🎫 Купить билет", url=poster["ticket_url"])]])
+    success_count = await broadcast(
+        context,
+        known_users,
+        lambda uid: context.bot.send_photo(
+            chat_id=uid, photo=poster["file_id"], caption=poster.get("caption", ""), reply_markup=reply_markup
+        ),
+    )
     
     logger.info("Broadcast completed: %d/%d users received the poster", 
                 success_count, len(known_users))
     
     # Отправляем админу отчет
-    admin_id = ADMIN_USER_ID
+    admin_id = CONFIG.admin_id
     if admin_id:
         try:
             report = f"📊 Рассылка завершена:\n"
@@ -1487,9 +2082,9 @@ def schedule_weekly(app: Application) -> None:
 
 
 async def _notify_admin_start(_: CallbackContext) -> None:
-    if ADMIN_USER_ID:
+    if CONFIG.admin_id:
         try:
-            await _.bot.send_message(ADMIN_USER_ID, "Бот запущен ✅")
+            await _.bot.send_message(CONFIG.admin_id, "Бот запущен ✅")
         except Exception:
             pass
 
@@ -1498,31 +2093,20 @@ async def _notify_admin_start(_: CallbackContext) -> None:
 # Registration Handler
 # ----------------------
 
-async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, user_data: dict, reg_step: str) -> None:
+async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState, reg_step: str) -> None:
     """Обработка шагов регистрации"""
     pool = get_db_pool(context)
     
     if reg_step == "name":
         name = text.strip()
-        user_data["name"] = name
-        user_data["registration_step"] = "gender"
+        st.name = name
+        st.registration_step = "gender"
+        # В БД имя попадёт одной записью вместе с остальными полями на шаге возраста
         
-        # Создаем минимальную запись в БД с именем
-        if pool:
-            try:
-                await upsert_user(pool, tg_id=user.id, name=name, username=user.username)
-                logger.info("Name saved to DB for user %s: %s", user.id, name)
-            except Exception as e:
-                logger.warning("Failed to save name to DB: %s", e)
-        
-        kb = [
-            [InlineKeyboardButton("👨 Мужской", callback_data="gender_male")],
-            [InlineKeyboardButton("👩 Женский", callback_data="gender_female")]
-        ]
         await update.message.reply_text(
             f"Приятно познакомиться, {name}! 😊\n\n"
             "Укажите ваш пол:",
-            reply_markup=InlineKeyboardMarkup(kb)
+            reply_markup=_GENDER_KB
         )
         return
     
@@ -1538,47 +2122,39 @@ async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT
                 )
                 return
                 
-            user_data["age"] = age
-            user_data["registered"] = True
-            user_data.pop("registration_step", None)
+            st.age = age
+            st.registered = True
+            st.registration_step = None
             
-            # Завершаем регистрацию - берем имя из памяти, а если нет - из БД
-            name = user_data.get("name")
-            if not name and pool:
-                try:
-                    async with pool.acquire() as conn:
-                        row = await conn.fetchrow("SELECT name FROM users WHERE tg_id = $1", user.id)
-                        if row and row['name']:
-                            name = row['name']
-                            user_data["name"] = name
-                except Exception as e:
-                    logger.warning("Failed to load name from DB: %s", e)
+            gender_text = _GENDER_TEXT.get(st.gender, "не указан")
             
-            if not name:
-                name = "Не указано"
-            
-            gender_text = {
-                "male": "мужской",
-                "female": "женский"
-            }.get(user_data.get("gender", ""), "не указан")
-            
-            # Обновляем все данные в БД
+            # Завершаем регистрацию одной записью в БД. Имя берём из памяти,
+            # а если его там нет - upsert оставит сохранённое и вернёт его
+            name = st.name
             if pool:
                 try:
-                    await upsert_user(
+                    saved_name = await upsert_user(
                         pool,
                         tg_id=user.id,
                         name=name,
-                        gender=user_data.get("gender"),
+                        gender=st.gender,
                         age=age,
-                        vk_id=user_data.get("vk_id"),
+                        vk_id=st.vk_id,
                         username=user.username,
                     )
+                    if not name and saved_name:
+                        name = st.name = saved_name
+                    if st.vk_id:
+                        _vk_ids[user.id] = st.vk_id
+                    get_known_users(context).add(user.id)
                     logger.info("Registration completed for user %s: %s", user.id, name)
                 except Exception as e:
                     logger.warning("DB upsert after registration failed: %s", e)
             
-            kb = [[InlineKeyboardButton("🎉 Перейти в меню", callback_data="back_to_menu")]]
+            if not name:
+                name = "Не указано"
+            
+            kb = _GO_TO_MENU_KB
             await update.message.reply_text(
                 f"🎉 Отлично! Вы прошли регистрацию!\n\n"
                 f"📝 Ваши данные:\n"
@@ -1586,7 +2162,7 @@ async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT
                 f"• Пол: {gender_text}\n"
                 f"• Возраст: {age} лет\n\n"
                 f"Теперь вы можете посещать наши вечеринки! 🥳",
-                reply_markup=InlineKeyboardMarkup(kb)
+                reply_markup=kb
             )
             return
         except ValueError:
@@ -1602,401 +2178,414 @@ async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT
 # Bootstrap
 # ----------------------
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Registration flow
-    if update.message and update.message.text:
-        text = update.message.text
-        user = update.effective_user
-        user_data = context.user_data
-        
-        # Автообновление username в фоне
-        await auto_update_username(update, context)
-        
-        # ПРИОРИТЕТ 1: Обработка регистрации (должна быть ПЕРВОЙ!)
-        reg_step = user_data.get("registration_step")
-        if reg_step:
-            # Пользователь в процессе регистрации - обрабатываем только это
-            await handle_registration_step(update, context, text, user, user_data, reg_step)
-            return
-        
-        # ПРИОРИТЕТ 2: Проверка подписки по username/ID (для админов)
-        if user_data.get("awaiting_username_check"):
-            # НЕ сбрасываем флаг здесь! Он будет сброшен после обработки, если НЕ в режиме continuous
-            
-            input_text = text.strip()
-            target_user_id = None
-            username_display = input_text
-            
-            try:
-                # Проверяем, это ID или username
-                if input_text.isdigit():
-                    # Это ID
-                    target_user_id = int(input_text)
-                    username_display = f"ID {input_text}"
-                else:
-                    # Это username - ищем в БД
-                    username = input_text.lstrip('@')
-                    username_display = f"@{username}"
-                    
-                    # Ищем пользователя в БД по username
-                    pool = get_db_pool(context)
-                    if pool:
-                        try:
-                            user_in_db = await get_user_by_username(pool, username)
-                            if user_in_db:
-                                target_user_id = user_in_db.get("tg_id")
-                                logger.info(f"Found user by username @{username}: ID={target_user_id}")
-                            else:
-                                logger.info(f"User @{username} not found in DB, trying get_chat...")
-                                # Если не нашли в БД, пробуем через get_chat (для публичных профилей)
-                                try:
-                                    target_chat = await context.bot.get_chat(f"@{username}")
-                                    target_user_id = target_chat.id
-                                    logger.info(f"Found user by get_chat @{username}: ID={target_user_id}")
-                                except Exception as e:
-                                    logger.warning(f"Failed to get_chat for @{username}: {e}")
-                        except Exception as e:
-                            logger.error(f"Error searching user by username in DB: {e}")
-                            # Пробуем get_chat если БД недоступна
-                            try:
-                                target_chat = await context.bot.get_chat(f"@{username}")
-                                target_user_id = target_chat.id
-                                logger.info(f"Found user by get_chat @{username}: ID={target_user_id}")
-                            except Exception as e2:
-                                logger.warning(f"Failed to get_chat for @{username}: {e2}")
-                    
-                    if not target_user_id:
-                        # Проверяем режим
-                        if context.user_data.get("continuous_check_mode"):
-                            kb = [[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]]
-                            await update.message.reply_text(
-                                f"❌ Пользователь @{username} не найден\n\n"
-                                f"Возможные причины:\n"
-                                f"• Username указан неверно\n"
-                                f"• Пользователь не взаимодействовал с ботом\n"
-                                f"• Профиль скрыт или удален\n\n"
-                                f"💡 Попробуйте ввести другой username или используйте Telegram ID",
-                                reply_markup=InlineKeyboardMarkup(kb)
-                            )
-                            # НЕ сбрасываем флаги
-                        else:
-                            context.user_data["awaiting_username_check"] = False
-                            await update.message.reply_text(
-                                f"❌ Пользователь @{username} не найден\n\n"
-                                f"Возможные причины:\n"
-                                f"• Username указан неверно\n"
-                                f"• Пользователь не взаимодействовал с ботом\n"
-                                f"• Профиль скрыт или удален\n\n"
-                                f"💡 **Рекомендация:** Используйте Telegram ID\n"
-                                f"Попросите пользователя написать @userinfobot",
-                                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
-                            )
-                        return
-                
-                if not target_user_id:
-                    await update.message.reply_text(
-                        "❌ Не удалось определить ID пользователя",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
-                    )
-                    return
-                
-                # Проверяем подписки на оба TG канала
-                tg1_ok, tg2_ok = await is_user_subscribed(context, target_user_id)
-                
-                # Проверяем VK (если есть привязка)
-                pool = get_db_pool(context)
-                vk_id = None
-                vk_status = None
-                if pool:
-                    try:
-                        user_in_db = await get_user(pool, target_user_id)
-                        vk_id = user_in_db.get("vk_id") if user_in_db else None
-                        if vk_id and VK_ENABLED:
-                            vk_status = await is_user_subscribed_vk(vk_id)
-                    except Exception:
-                        pass
-                
-                # Формируем отчет (экранируем специальные символы Markdown)
-                def escape_markdown(text):
-                    """Экранирует специальные символы для Markdown"""
-                    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-                    for char in special_chars:
-                        text = text.replace(char, '\\' + char)
-                    return text
-                
-                username_safe = escape_markdown(str(username_display))
-                
-                report = f"🔍 **Проверка подписок для {username_safe}**\n\n"
-                report += f"👤 Telegram ID: `{target_user_id}`\n\n"
-                report += "📺 **Telegram каналы:**\n"
-                report += f"{'✅' if tg1_ok else '❌'} {CHANNEL_USERNAME} \\(Largent MSK\\)\n"
-                report += f"{'✅' if tg2_ok else '❌'} {CHANNEL_USERNAME_2} \\(IDN Records\\)\n\n"
-                
-                if VK_ENABLED:
-                    report += "🎵 **VK группа:**\n"
-                    if not vk_id:
-                        report += "⚠️ VK профиль не привязан\n"
-                    elif vk_status is None:
-                        report += f"❓ VK ID: {vk_id} \\- не удалось проверить\n"
-                    elif vk_status:
-                        report += f"✅ VK ID: {vk_id}\n"
-                    else:
-                        report += f"❌ VK ID: {vk_id} \\- не подписан\n"
-                
-                all_ok = tg1_ok and tg2_ok and (not VK_ENABLED or vk_status)
-                report += f"\n{'🎉 **Все подписки активны\\!**' if all_ok else '⚠️ **Не все подписки активны**'}"
-                
-                # Кнопки в зависимости от режима
-                if context.user_data.get("continuous_check_mode"):
-                    # Режим непрерывной проверки - оставляем флаг активным
-                    kb = [[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]]
-                    await update.message.reply_text(
-                        report + "\n\n💡 Введите следующий username или нажмите 'Завершить проверку'",
-                        reply_markup=InlineKeyboardMarkup(kb),
-                        parse_mode="MarkdownV2"
-                    )
-                    # НЕ сбрасываем флаг awaiting_username_check!
-                else:
-                    # Обычный режим - одна проверка
-                    context.user_data["awaiting_username_check"] = False
-                    await update.message.reply_text(
-                        report,
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]]),
-                        parse_mode="MarkdownV2"
-                    )
-                return
-                
-            except Exception as e:
-                logger.error("Error checking subscriptions by username: %s", e)
-                
+async def _text_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState) -> None:
+    # Пользователь в процессе регистрации - обрабатываем только это
+    await handle_registration_step(update, context, text, user, st, st.registration_step)
+
+
+async def _text_username_check(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState) -> None:
+    # Проверка подписки по username/ID (для админов)
+    # НЕ сбрасываем флаг здесь! Он будет сброшен после обработки, если НЕ в режиме continuous
+
+    input_text = text.strip()
+    target_user_id = None
+    username_display = input_text
+
+    try:
+        # Проверяем, это ID или username
+        if input_text.isdigit():
+            # Это ID
+            target_user_id = int(input_text)
+            username_display = f"ID {input_text}"
+        else:
+            # Это username - ищем в БД
+            username = input_text.lstrip('@')
+            username_display = f"@{username}"
+
+            # Ищем пользователя в БД по username (с кешем)
+            target_user_id = await resolve_tg_username(context, username)
+
+            if not target_user_id:
                 # Проверяем режим
-                if context.user_data.get("continuous_check_mode"):
-                    kb = [[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]]
+                if st.continuous_check_mode:
+                    kb = _STOP_CHECK_KB
                     await update.message.reply_text(
-                        f"❌ Ошибка при проверке подписок:\n{str(e)}\n\n"
-                        f"💡 Попробуйте ввести другой username",
-                        reply_markup=InlineKeyboardMarkup(kb)
+                        f"❌ Пользователь @{username} не найден\n\n"
+                        f"Возможные причины:\n"
+                        f"• Username указан неверно\n"
+                        f"• Пользователь не взаимодействовал с ботом\n"
+                        f"• Профиль скрыт или удален\n\n"
+                        f"💡 Попробуйте ввести другой username или используйте Telegram ID",
+                        reply_markup=kb
                     )
                     # НЕ сбрасываем флаги
                 else:
-                    context.user_data["awaiting_username_check"] = False
+                    st.awaiting_username_check = False
                     await update.message.reply_text(
-                        f"❌ Ошибка при проверке подписок:\n{str(e)}",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
+                        f"❌ Пользователь @{username} не найден\n\n"
+                        f"Возможные причины:\n"
+                        f"• Username указан неверно\n"
+                        f"• Пользователь не взаимодействовал с ботом\n"
+                        f"• Профиль скрыт или удален\n\n"
+                        f"💡 **Рекомендация:** Используйте Telegram ID\n"
+                        f"Попросите пользователя написать @userinfobot",
+                        reply_markup=_BACK_TO_PANEL_KB
                     )
                 return
-        
-        # Админские команды теперь только через inline кнопки в админ-панели
-        # Оставляем только обработку ввода данных
-        # Handle admin text inputs
-        if context.user_data.get("awaiting_ticket"):
-            context.user_data["awaiting_ticket"] = False
-            url = update.message.text.strip()
-            poster = context.bot_data.get("poster") or {}
-            poster["ticket_url"] = url
-            context.bot_data["poster"] = poster
-            await update.message.reply_text("Ссылка сохранена ✅")
-            return
-            
-        if context.user_data.get("awaiting_broadcast_text"):
-            context.user_data["awaiting_broadcast_text"] = False
-            text = update.message.text
-            for uid in list(get_known_users(context)):
-                try:
-                    await context.bot.send_message(uid, text)
-                except Forbidden:
-                    logger.info("Cannot message user %s (blocked)", uid)
-                except Exception as e:
-                    logger.warning("Broadcast text failed to %s: %s", uid, e)
-            await update.message.reply_text("Текстовая рассылка отправлена ✅")
+
+        if not target_user_id:
+            await update.message.reply_text(
+                "❌ Не удалось определить ID пользователя",
+                reply_markup=_BACK_TO_PANEL_KB
+            )
             return
-        
-        # Poster draft: expecting caption or link
-        draft = context.user_data.get("poster_draft")
-        if draft:
-            step = draft.get("step")
-            if step == "caption":
-                draft["caption"] = update.message.text
-                draft["step"] = "link"
-                context.user_data["poster_draft"] = draft
-                await update.message.reply_text(
-                    "Шаг 3/4: пришлите ссылку для кнопки «Купить билет»",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отмена", callback_data="admin:cancel_poster")],
-                        [InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")],
-                    ]),
-                )
-                return
-            if step == "link":
-                url = update.message.text.strip()
-                draft["ticket_url"] = url
-                draft["step"] = "preview"
-                context.user_data["poster_draft"] = draft
-                # Предпросмотр: отправим фото с подписью и кнопкой
-                rm = None
-                if url:
-                    rm = InlineKeyboardMarkup([[InlineKeyboardButton("Купить билет", url=url)]])
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=draft["file_id"],
-                    caption=draft.get("caption") or "",
-                    reply_markup=rm,
-                )
-                await update.message.reply_text(
-                    "Шаг 4/4: подтвердить публикацию?",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ Подтвердить", callback_data="admin:confirm_poster")],
-                        [InlineKeyboardButton("❌ Отмена", callback_data="admin:cancel_poster")],
-                        [InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")],
-                    ]),
-                )
-                return
-        if VK_ENABLED and context.user_data.get("awaiting_vk"):
-            context.user_data["awaiting_vk"] = False
-            vk_input = update.message.text.strip()
-            
-            # Проверяем формат: цифры, id123456, или никнейм
-            if not vk_input:
-                kb = [[InlineKeyboardButton("🔗 Попробовать еще раз", callback_data="link_vk")]]
-                await update.message.reply_text(
-                    "❌ **Пустое поле**\n\n"
-                    "Введите ваш VK ID или никнейм",
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode="Markdown"
-                )
-                return
-            
-            # Проверяем что это валидный формат VK ID/никнейма
-            is_valid = (
-                vk_input.isdigit() or  # только цифры: 123456789
-                (vk_input.lower().startswith('id') and vk_input[2:].isdigit()) or  # id123456789
-                (len(vk_input) >= 3 and vk_input.replace('_', '').replace('.', '').isalnum())  # никнейм: durov, ivan_petrov
+
+        # Подписки на оба TG канала и VK (если есть привязка) проверяем одновременно
+        (tg1_ok, tg2_ok), (vk_id, vk_status) = await asyncio.gather(
+            is_user_subscribed(context, target_user_id),
+            check_linked_vk(context, target_user_id),
+        )
+
+        # Формируем отчет (экранируем специальные символы Markdown)
+        username_safe = escape_markdown_v2(str(username_display))
+
+        report = f"🔍 **Проверка подписок для {username_safe}**\n\n"
+        report += f"👤 Telegram ID: `{target_user_id}`\n\n"
+        report += "📺 **Telegram каналы:**\n"
+        report += f"{'✅' if tg1_ok else '❌'} {CONFIG.channel_id} \\(Largent MSK\\)\n"
+        report += f"{'✅' if tg2_ok else '❌'} {CONFIG.channel_id_2} \\(IDN Records\\)\n\n"
+
+        if VK_ENABLED:
+            report += "🎵 **VK группа:**\n"
+            vk_safe = escape_markdown_v2(vk_id) if vk_id else ""
+            if not vk_id:
+                report += "⚠️ VK профиль не привязан\n"
+            elif vk_status is None:
+                report += f"❓ VK ID: {vk_safe} \\- не удалось проверить\n"
+            elif vk_status:
+                report += f"✅ VK ID: {vk_safe}\n"
+            else:
+                report += f"❌ VK ID: {vk_safe} \\- не подписан\n"
+
+        all_ok = tg1_ok and tg2_ok and (not VK_ENABLED or vk_status)
+        report += "\n🎉 **Все подписки активны\\!**" if all_ok else "\n⚠️ **Не все подписки активны**"
+
+        # Кнопки в зависимости от режима
+        if st.continuous_check_mode:
+            # Режим непрерывной проверки - оставляем флаг активным
+            kb = _STOP_CHECK_KB
+            await update.message.reply_text(
+                report + "\n\n💡 Введите следующий username или нажмите 'Завершить проверку'",
+                reply_markup=kb,
+                parse_mode="MarkdownV2"
             )
-            
-            if not is_valid:
-                kb = [[InlineKeyboardButton("🔗 Попробовать еще раз", callback_data="link_vk")]]
-                await update.message.reply_text(
-                    "❌ **Неверный формат VK ID/никнейма**\n\n"
-                    "Поддерживаемые форматы:\n"
-                    "• **Цифры:** 123456789\n"
-                    "• **ID:** id123456789\n"
-                    "• **Никнейм:** durov, ivan_petrov\n\n"
-                    "📍 Найти можно в адресной строке профиля VK",
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode="Markdown"
-                )
+            # НЕ сбрасываем флаг awaiting_username_check!
+        else:
+            # Обычный режим - одна проверка
+            st.awaiting_username_check = False
+            await update.message.reply_text(
+                report,
+                reply_markup=_BACK_TO_PANEL_KB,
+                parse_mode="MarkdownV2"
+            )
+        return
+
+    except Exception as e:
+        logger.error("Error checking subscriptions by username: %s", e)
+
+        # Проверяем режим
+        if st.continuous_check_mode:
+            kb = _STOP_CHECK_KB
+            await update.message.reply_text(
+                f"❌ Ошибка при проверке подписок:\n{str(e)}\n\n"
+                f"💡 Попробуйте ввести другой username",
+                reply_markup=kb
+            )
+            # НЕ сбрасываем флаги
+        else:
+            st.awaiting_username_check = False
+            await update.message.reply_text(
+                f"❌ Ошибка при проверке подписок:\n{str(e)}",
+                reply_markup=_BACK_TO_PANEL_KB
+            )
+        return
+
+
+async def _text_ticket_url(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState) -> None:
+    st.awaiting_ticket = False
+    url = update.message.text.strip()
+    if not await set_latest_ticket_url(context, url):
+        await update.message.reply_text("Нет афиши для ссылки ❌")
+        return
+    await update.message.reply_text("Ссылка сохранена ✅")
+
+
+async def _text_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState) -> None:
+    st.awaiting_broadcast_text = False
+    delivered = await copy_to_all(context, update.message)
+    await update.message.reply_text(f"Текстовая рассылка отправлена ✅\nДоставлено: {delivered}")
+
+
+async def _text_poster_draft(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState) -> None:
+    # Мастер афиши: ждём подпись или ссылку
+    draft = st.poster_draft
+    step = draft.step
+    if step == "caption":
+        draft.caption = clean_caption(update.message.text)
+        draft.step = "link"
+        await update.message.reply_text(
+            "Шаг 3/4: пришлите ссылку для кнопки «Купить билет»",
+            reply_markup=_POSTER_STEP_KB,
+        )
+        return
+    if step == "link":
+        url = update.message.text.strip()
+        draft.ticket_url = url
+        draft.step = "preview"
+        # Предпросмотр: отправим фото с подписью и кнопкой
+        rm = None
+        if url:
+            rm = InlineKeyboardMarkup([[InlineKeyboardButton("Купить билет", url=url)]])
+        await context.bot.send_photo(
+            chat_id=update.effective_chat.id,
+            photo=draft.file_id,
+            caption=draft.caption or "",
+            reply_markup=rm,
+        )
+        await update.message.reply_text(
+            "Шаг 4/4: подтвердить публикацию?",
+            reply_markup=_CONFIRM_POSTER_KB,
+        )
+        return
+
+
+async def _text_vk_link(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user, st: UserState) -> None:
+    if not VK_ENABLED:
+        return
+    st.awaiting_vk = False
+    # VK ID и никнеймы регистронезависимы: приводим к нижнему регистру один раз
+    vk_input = update.message.text.strip().lower()
+    # Ссылку на профиль (vk.com/durov) сводим к самому ID/никнейму
+    profile = VK_PROFILE_RE.match(vk_input)
+    if profile:
+        vk_input = profile.group(1)
+
+    # Проверяем формат: цифры, id123456, или никнейм
+    if not vk_input:
+        kb = _RETRY_VK_KB
+        await update.message.reply_text(
+            "❌ **Пустое поле**\n\n"
+            "Введите ваш VK ID или никнейм",
+            reply_markup=kb,
+            parse_mode="Markdown"
+        )
+        return
+
+    # Проверяем что это валидный формат VK ID/никнейма
+    if not _VK_INPUT_RE.fullmatch(vk_input):
+        kb = _RETRY_VK_KB
+        await update.message.reply_text(
+            "❌ **Неверный формат VK ID/никнейма**\n\n"
+            "Поддерживаемые форматы:\n"
+            "• **Цифры:** 123456789\n"
+            "• **ID:** id123456789\n"
+            "• **Никнейм:** durov, ivan_petrov\n\n"
+            "📍 Найти можно в адресной строке профиля VK",
+            reply_markup=kb,
+            parse_mode="Markdown"
+        )
+        return
+
+    # Проверяем была ли это перепривязка
+    was_relink = bool(st.vk_id)
+
+    vk_id = vk_input
+    st.vk_id = vk_id
+
+    # Persist VK link to database
+    pool = get_db_pool(context)
+    if pool:
+        try:
+            # Тот же подготовленный upsert, что и при регистрации; остальные поля COALESCE сохранит
+            await upsert_user(pool, tg_id=user.id, vk_id=vk_id)
+            _vk_ids[user.id] = vk_id
+            get_known_users(context).add(user.id)
+            # Сбрасываем кеш данных пользователя, чтобы перечитать их из БД
+            st.db_cached_at = None
+            logger.info("VK ID %s linked to user %s", vk_id, user.id)
+        except Exception as e:
+            logger.warning("Failed to save VK ID of %s: %s", user.id, e)
+
+    action_text = "перепривязан" if was_relink else "привязан"
+    await update.message.reply_text(
+        f"✅ **VK профиль успешно {action_text}!**",
+        reply_markup=_MAIN_MENU_KB,
+        parse_mode="Markdown"
+    )
+
+
+# Обработчики текста по состоянию пользователя в порядке приоритета:
+# срабатывает первый, у которого поле UserState непустое. Регистрация
+# должна идти первой.
+_TEXT_STATE_HANDLERS = (
+    ("registration_step", _text_registration),
+    ("awaiting_username_check", _text_username_check),
+    ("awaiting_ticket", _text_ticket_url),
+    ("awaiting_broadcast_text", _text_broadcast),
+    ("poster_draft", _text_poster_draft),
+    ("awaiting_vk", _text_vk_link),
+)
+
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message and update.message.text:
+        text = update.message.text
+        user = update.effective_user
+        st = get_user_state(context)
+        
+        # Автообновление username в фоне
+        context.application.create_task(auto_update_username(update, context), update=update)
+        
+        for attr, handler in _TEXT_STATE_HANDLERS:
+            if getattr(st, attr):
+                await handler(update, context, text, user, st)
                 return
-            
-            # Проверяем была ли это перепривязка
-            was_relink = bool(context.user_data.get("vk_id"))
-            
-            vk_id = vk_input
-            context.user_data["vk_id"] = vk_id
-            
-            # Persist VK link to database
-            pool = get_db_pool(context)
-            if pool:
-                try:
-                    await set_vk_id(pool, user.id, vk_id)
-                    # Обновляем кеш
-                    vk_cache = context.bot_data.get("user_vk_cache", {})
-                    vk_cache[user.id] = vk_id
-                    context.bot_data["user_vk_cache"] = vk_cache
-                    logger.info("VK ID %s linked to user %s", vk_id, user.id)
-                except Exception as e:
-                    logger.warning("DB set_vk_id failed: %s", e)
-            
-            # Проверяем подписку сразу после привязки
-            status = await is_user_subscribed_vk(vk_id)
-            
-            kb = [[InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")]]
-            
-            if status is None:
-                action_text = "перепривязан" if was_relink else "привязан"
-                await update.message.reply_text(
-                    f"✅ **VK профиль успешно {action_text}!**",
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode="Markdown"
-                )
-            elif status:
-                action_text = "перепривязан" if was_relink else "привязан"
-                await update.message.reply_text(
-                    f"✅ **VK профиль успешно {action_text}!**",
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode="Markdown"
-                )
-            else:
-                action_text = "перепривязан" if was_relink else "привязан"
-                await update.message.reply_text(
-                    f"✅ **VK профиль успешно {action_text}!**",
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode="Markdown"
-                )
-            return
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Poster draft: expecting photo at step 'photo'
-    draft = context.user_data.get("poster_draft")
-    if draft and draft.get("step") == "photo" and update.message.photo:
+    draft = get_user_state(context).poster_draft
+    if draft and draft.step == "photo" and update.message.photo:
         largest = update.message.photo[-1]
-        draft["file_id"] = largest.file_id
-        draft["step"] = "caption"
-        context.user_data["poster_draft"] = draft
+        draft.file_id = largest.file_id
+        draft.step = "caption"
         await update.message.reply_text(
             "Шаг 2/4: пришлите текст (подпись) для афиши",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ Отмена", callback_data="admin:cancel_poster")],
-                [InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")],
-            ]),
+            reply_markup=_POSTER_STEP_KB,
         )
         return
     # если фото вне мастера — ничего не делаем
 
 
+# HTTP/2 в httpx работает только при установленном h2
+_HTTP_VERSION = "2" if importlib.util.find_spec("h2") is not None else "1.1"
+
+
 def build_app() -> Application:
     """Build and configure the Application"""
     ensure_data_dir()
-    persistence = PicklePersistence(filepath=str(PERSISTENCE_FILE))
+    # Состояние пользователей хранится в Postgres; старый pickle-файл
+    # переносится в БД при первом запуске
+    persistence = None
+    if CONFIG.persist_state:
+        persistence = PostgresPersistence(
+            create_pool,
+            legacy_file=PERSISTENCE_FILE,
+            user_data_loader=user_data_from_json,
+            bot_data_loader=bot_data_from_json,
+        )
     
-    # Create request with timeout and proxy support
-    request = None
-    if PROXY_URL:
-        from httpx import AsyncClient
-        from telegram.request import HTTPXRequest
-        client = AsyncClient(proxies=PROXY_URL, timeout=30.0)
-        request = HTTPXRequest(http_client=client)
+    # Create requests with timeout and proxy support.
+    # Общий пул должен вмещать параллельные send_message/get_chat_member
+    # (рассылки, проверки подписок), иначе PTB упирается в pool timeout.
+    # get_updates держит одно long-poll соединение, ему хватает маленького пула.
+    # HTTP/2 (если установлен пакет h2) мультиплексирует эти запросы в
+    # нескольких соединениях вместо отдельного TLS-соединения на каждый.
+    proxy_url = CONFIG.proxy_url or None
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        proxy_url=proxy_url,
+        connect_timeout=5.0,
+        read_timeout=15.0,
+        pool_timeout=10.0,
+        http_version=_HTTP_VERSION,
+    )
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=4,
+        proxy_url=proxy_url,
+        pool_timeout=10.0,
+    )
     
-    app = ApplicationBuilder().token(BOT_TOKEN).persistence(persistence).request(request).build()
+    app = (
+        ApplicationBuilder()
+        .token(CONFIG.bot_token)
+        .persistence(persistence)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        # Держит общий лимит Telegram (~30 сообщений/с) и повторяет запросы после 429
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .build()
+    )
 
     # DB lifecycle
+    async def _init_db(app: Application) -> None:
+        global _user_upserts, _db_pool
+        # Пул уже создан persistence при загрузке состояния - используем его же
+        pool = await persistence.get_pool() if persistence else await create_pool()
+        await init_schema(pool)
+        _db_pool = pool
+        
+        _user_upserts = UpsertQueue(pool)
+        _user_upserts.start()
+        
+        # Пользователи, афиши и привязанные VK ID загружаются независимо
+        user_ids, posters_loaded, vk_synced = await asyncio.gather(
+            get_active_user_ids(pool),
+            load_posters(app),
+            _start_vk_sync(pool),
+            return_exceptions=True,
+        )
+        if isinstance(user_ids, Exception):
+            logger.error("Failed to load users from DB: %s", user_ids)
+            user_ids = []
+        _known_users.update(user_ids)
+        if isinstance(posters_loaded, Exception):
+            logger.error("Failed to load posters from DB: %s", posters_loaded)
+        if isinstance(vk_synced, Exception):
+            logger.error("Failed to load VK ids from DB: %s", vk_synced)
+        
+        logger.info("DB pool initialized, schema ready, loaded %d users", len(user_ids))
+
     async def _on_startup(app: Application):
-        try:
-            pool = await create_pool()
-            await init_schema(pool)
-            app.bot_data["db_pool"] = pool
-            
-            # Загружаем существующих пользователей из БД
-            user_ids = await get_all_user_ids(pool)
-            app.bot_data["known_users"] = set(user_ids)
-            
-            # Загружаем VK данные для кеширования
-            vk_data = await load_user_vk_data(pool)
-            app.bot_data["user_vk_cache"] = vk_data
-            
-            # Настраиваем команды бота (только для обычных пользователей)
-            commands = [
-                BotCommand("start", "Начать работу с ботом"),
-                BotCommand("menu", "Главное меню")
-            ]
-            await app.bot.set_my_commands(commands)
-            
-            logger.info("DB pool initialized, schema ready, loaded %d users, commands set", len(user_ids))
-        except Exception as e:
-            logger.error("Failed to init DB: %s", e)
+        # Переносим множество из старого сохранённого bot_data, чтобы больше его не сохранять
+        _known_users.update(app.bot_data.pop("known_users", ()))
+        # Старые версии держали в bot_data пул и копию VK id всех пользователей
+        app.bot_data.pop("db_pool", None)
+        app.bot_data.pop("user_vk_cache", None)
+        # Кеш статуса бота в канале больше не ведётся
+        app.bot_data.pop("bot_channel_status", None)
+        if VK_ENABLED:
+            get_vk_http()
+        
+        # Команды бота (только для обычных пользователей)
+        commands = [
+            BotCommand("start", "Начать работу с ботом"),
+            BotCommand("menu", "Главное меню")
+        ]
+        # Команды, id группы VK и загрузка из БД друг от друга не зависят
+        commands_set, vk_group, db_ready = await asyncio.gather(
+            app.bot.set_my_commands(commands),
+            get_vk_group_id() if VK_ENABLED else asyncio.sleep(0),
+            _init_db(app),
+            return_exceptions=True,
+        )
+        if isinstance(commands_set, Exception):
+            logger.warning("Failed to set bot commands: %s", commands_set)
+        if isinstance(vk_group, Exception):
+            logger.warning("Failed to resolve VK group id on startup: %s", vk_group)
+        if isinstance(db_ready, Exception):
+            logger.error("Failed to init DB: %s", db_ready)
+        if not _all_posters:
+            # Без БД показываем афиши, сохранённые в bot_data
+            _all_posters[:] = app.bot_data.get("all_posters") or []
 
     async def _on_shutdown(app: Application):
-        pool = app.bot_data.get("db_pool")
+        await close_vk_http()
+        if _user_upserts:
+            await _user_upserts.close()
+        if _vk_listener:
+            await _vk_listener.close()
+        pool = _db_pool
         if pool:
             try:
                 await pool.close()
@@ -1,6 +1,10 @@
 import os
+import asyncio
+import logging
 import asyncpg
-from typing import Optional, Any, Dict
+from asyncpg.prepared_stmt import PreparedStatement
+from contextlib import nullcontext
+from typing import Optional, Any, AsyncContextManager, Callable, Dict, Union
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла
@@ -12,6 +16,57 @@ DB_PORT = int(os.getenv("DB_PORT", "5432"))
 DB_NAME = os.getenv("DB_NAME", "largent")
 DB_USER = os.getenv("DB_USER", "tusabot_user")  # Исправлен дефолт
 DB_PASSWORD = os.getenv("DB_PASSWORD", "1")
+# Верхняя граница ~0.3-0.5 от числа одновременных обработчиков, которые ходят в БД
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "30"))
+
+
+class PreparedConnection(asyncpg.Connection):
+    """Соединение, которое держит подготовленные запросы из ``HOT_STATEMENTS``.
+
+    Запросы готовятся в ``init`` пула сразу при открытии соединения, поэтому
+    первый запрос на свежем соединении не тратит лишний обмен на Parse.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.statements: Dict[str, PreparedStatement] = {}
+
+    async def statement(self, sql: str) -> PreparedStatement:
+        stmt = self.statements.get(sql)
+        if stmt is None:
+            stmt = self.statements[sql] = await self.prepare(sql)
+        return stmt
+
+
+async def _prepare_hot_statements(conn: PreparedConnection) -> None:
+    for sql in HOT_STATEMENTS:
+        try:
+            await conn.statement(sql)
+        except asyncpg.PostgresError:
+            # Схема ещё не создана (init_schema идёт следом) - подготовим при первом запросе
+            return
+
+
+# Пул или уже взятое из него соединение: обработчик, которому нужно несколько
+# запросов подряд, держит одно соединение вместо acquire/release на каждый
+PoolOrConn = Union[asyncpg.Pool, PreparedConnection]
+
+
+def _connection(pool: PoolOrConn) -> AsyncContextManager[PreparedConnection]:
+    if isinstance(pool, asyncpg.Pool):
+        return pool.acquire()
+    return nullcontext(pool)
+
+
+async def _run_prepared(pool: PoolOrConn, method: str, sql: str, *args: Any) -> Any:
+    async with _connection(pool) as conn:
+        try:
+            return await getattr(await conn.statement(sql), method)(*args)
+        except asyncpg.InvalidCachedStatementError:
+            # Таблицу изменили на живой БД - старый план больше не годится
+            conn.statements.pop(sql, None)
+            return await getattr(await conn.statement(sql), method)(*args)
 
 
 async def create_pool() -> asyncpg.Pool:
@@ -21,174 +76,580 @@ async def create_pool() -> asyncpg.Pool:
         database=DB_NAME,
         user=DB_USER,
         password=DB_PASSWORD,
-        min_size=1,
-        max_size=10,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        # Запросов немного и они одинаковые - пусть все остаются подготовленными
+        statement_cache_size=1024,
+        # Простаивающие сверх min_size соединения закрываем через 5 минут
+        max_inactive_connection_lifetime=300,
+        # Соединение пересоздаётся после 50000 запросов, чтобы не копить память на сервере
+        max_queries=50000,
         command_timeout=30,
+        connection_class=PreparedConnection,
+        init=_prepare_hot_statements,
     )
 
 
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    tg_id BIGINT PRIMARY KEY,
+    name TEXT,
+    gender TEXT CHECK (gender IN ('male', 'female')),
+    age INTEGER CHECK (age >= 14 AND age <= 100),
+    vk_id TEXT,
+    username TEXT,
+    registered_at TIMESTAMPTZ DEFAULT now(),
+    created_at TIMESTAMPTZ DEFAULT now(),
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS posters (
+    id SERIAL PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    caption TEXT,
+    ticket_url TEXT,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    is_active BOOLEAN DEFAULT true
+);
+
+-- Недели посещений и счётчик пропусков (для напоминаний пропавшим)
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS attended_weeks TEXT[] NOT NULL DEFAULT '{}',
+    ADD COLUMN IF NOT EXISTS missed_in_row INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT true;
+
+-- Поиск по username идёт через LOWER(username) - обычный индекс по username тут не помогает
+CREATE INDEX IF NOT EXISTS users_username_lower_idx ON users (LOWER(username));
+
+-- Функция и триггер для автоматического обновления updated_at в таблице users
+CREATE OR REPLACE FUNCTION update_updated_at_column()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = now();
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS update_users_updated_at ON users;
+
+CREATE TRIGGER update_users_updated_at 
+    BEFORE UPDATE ON users 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- Оповещение об изменении vk_id (канал VK_CHANNEL, см. VkIdListener)
+CREATE OR REPLACE FUNCTION notify_vk_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF (TG_OP = 'INSERT' AND NEW.vk_id IS NOT NULL)
+       OR (TG_OP = 'UPDATE' AND NEW.vk_id IS DISTINCT FROM OLD.vk_id) THEN
+        PERFORM pg_notify('users_vk_changed', NEW.tg_id::text || ':' || COALESCE(NEW.vk_id, ''));
+    END IF;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS users_vk_changed ON users;
+
+CREATE TRIGGER users_vk_changed
+    AFTER INSERT OR UPDATE OF vk_id ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_vk_change();
+"""
+
+
 async def init_schema(pool: asyncpg.Pool) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                tg_id BIGINT PRIMARY KEY,
-                name TEXT,
-                gender TEXT CHECK (gender IN ('male', 'female')),
-                age INTEGER CHECK (age >= 14 AND age <= 100),
-                vk_id TEXT,
-                username TEXT,
-                registered_at TIMESTAMPTZ DEFAULT now(),
-                created_at TIMESTAMPTZ DEFAULT now(),
-                updated_at TIMESTAMPTZ DEFAULT now()
-            );
-            """
-        )
-        
-        # Создание функции для автоматического обновления updated_at
-        await conn.execute(
-            """
-            CREATE OR REPLACE FUNCTION update_updated_at_column()
-            RETURNS TRIGGER AS $$
-            BEGIN
-                NEW.updated_at = now();
-                RETURN NEW;
-            END;
-            $$ language 'plpgsql';
-            """
-        )
-        
-        # Создание триггера для автоматического обновления updated_at в таблице users
-        await conn.execute(
-            """
-            DROP TRIGGER IF EXISTS update_users_updated_at ON users;
-            """
-        )
-        await conn.execute(
-            """
-            CREATE TRIGGER update_users_updated_at 
-                BEFORE UPDATE ON users 
-                FOR EACH ROW 
-                EXECUTE FUNCTION update_updated_at_column();
-            """
-        )
+    # Без параметров execute идёт простым протоколом: весь скрипт за один обмен с сервером
+    await pool.execute(SCHEMA_SQL)
+
+
+USER_COLUMNS = ("tg_id", "name", "gender", "age", "vk_id", "username")
+
+# Правило слияния для строк с разным набором заполненных полей (COPY в
+# migrate_users_to_db.py): None-поля не затирают сохранённые
+USER_ONCONFLICT = """
+    ON CONFLICT (tg_id) DO UPDATE
+    SET name = COALESCE(EXCLUDED.name, users.name),
+        gender = COALESCE(EXCLUDED.gender, users.gender),
+        age = COALESCE(EXCLUDED.age, users.age),
+        vk_id = COALESCE(EXCLUDED.vk_id, users.vk_id),
+        username = COALESCE(EXCLUDED.username, users.username),
+        is_active = true
+"""
+
+# 500 строк x 6 параметров = 3000, с запасом ниже лимита Postgres в 32767
+UPSERT_CHUNK = 500
+
+# Однострочные upsert-ы по набору обновляемых столбцов (их не больше 2^5)
+_upsert_user_sql: Dict[tuple[str, ...], str] = {}
+
+
+def _upsert_users_sql(updated: tuple[str, ...], count: int) -> str:
+    """INSERT на ``count`` строк, обновляющий у существующих только столбцы ``updated``.
+
+    Пустой ``updated`` - менять нечего: у существующей строки только
+    возвращается is_active, если пользователь был отключён; активная строка
+    не трогается (ни записи в WAL, ни срабатывания триггера updated_at)
+    и не возвращается.
+    """
+    if count == 1 and updated in _upsert_user_sql:
+        return _upsert_user_sql[updated]
+    width = len(USER_COLUMNS)
+    values = ", ".join(
+        "(" + ", ".join(f"${i * width + j + 1}" for j in range(width)) + ")"
+        for i in range(count)
+    )
+    if updated:
+        sets = ", ".join(f"{c} = EXCLUDED.{c}" for c in updated)
+        conflict = f"ON CONFLICT (tg_id) DO UPDATE SET {sets}, is_active = true"
+    else:
+        conflict = "ON CONFLICT (tg_id) DO UPDATE SET is_active = true WHERE NOT users.is_active"
+    sql = (
+        f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES {values} "
+        f"{conflict} RETURNING tg_id, name;"
+    )
+    if count == 1:
+        _upsert_user_sql[updated] = sql
+    return sql
+
+
+async def upsert_users_bulk(pool: PoolOrConn, rows: list[dict]) -> Dict[int, Optional[str]]:
+    """Создать или обновить пачку пользователей многострочными INSERT по ``UPSERT_CHUNK`` строк.
+
+    Строки с одинаковым tg_id сливаются заранее (Postgres не даёт одному
+    INSERT ... ON CONFLICT дважды изменить одну строку); более поздние
+    не-None значения побеждают. Строки группируются по набору заполненных
+    полей, и у существующих пользователей обновляются только они.
+    Возвращает {tg_id: имя из итоговой строки} для вставленных и обновлённых.
+    """
+    logger = logging.getLogger("TusaBot")
+
+    merged: Dict[int, dict] = {}
+    for row in rows:
+        tg_id = row["tg_id"]
+        current = merged.setdefault(tg_id, dict.fromkeys(USER_COLUMNS))
+        current.update((k, v) for k, v in row.items() if v is not None)
+    groups: Dict[tuple[str, ...], list[tuple]] = {}
+    for r in merged.values():
+        updated = tuple(c for c in USER_COLUMNS[1:] if r[c] is not None)
+        groups.setdefault(updated, []).append(tuple(r[c] for c in USER_COLUMNS))
+
+    names: Dict[int, Optional[str]] = {}
+    async with _connection(pool) as conn:
+        for updated, records in groups.items():
+            for start in range(0, len(records), UPSERT_CHUNK):
+                chunk = records[start:start + UPSERT_CHUNK]
+                sql = _upsert_users_sql(updated, len(chunk))
+                args = [v for r in chunk for v in r]
+                try:
+                    if len(chunk) == 1:
+                        result = await _run_prepared(conn, "fetch", sql, *args)
+                    else:
+                        result = await conn.fetch(sql, *args)
+                except Exception as e:
+                    logger.error("Failed to upsert %d users: %s", len(chunk), e)
+                    raise
+                names.update((r["tg_id"], r["name"]) for r in result)
+    logger.debug("Upserted %d users", len(merged))
+    return names
 
 
 async def upsert_user(
-    pool: asyncpg.Pool,
+    pool: PoolOrConn,
     tg_id: int,
     name: Optional[str] = None,
     gender: Optional[str] = None,
     age: Optional[int] = None,
     vk_id: Optional[str] = None,
     username: Optional[str] = None,
-) -> None:
-    import logging
-    logger = logging.getLogger("TusaBot")
-    
-    async with pool.acquire() as conn:
+) -> Optional[str]:
+    """Создать или обновить пользователя; None-поля не затирают сохранённые.
+
+    Возвращает имя из итоговой строки, чтобы не перечитывать его отдельно
+    (None, если все поля None и пользователь уже есть - тогда меняется разве что is_active).
+    """
+    names = await upsert_users_bulk(pool, [{
+        "tg_id": tg_id,
+        "name": name,
+        "gender": gender,
+        "age": age,
+        "vk_id": vk_id,
+        "username": username,
+    }])
+    return names.get(tg_id)
+
+
+class UpsertQueue:
+    """Собирает (tg_id, username) из частых /start и пишет их пачкой.
+
+    Вместо отдельной транзакции на каждое нажатие /start строки копятся
+    до ``max_batch`` штук или ``interval`` секунд и уходят executemany
+    (отдельно строки с username и без него).
+    """
+
+    # Те же upsert-ы, что и у upsert_user: с username обновляем его,
+    # без username сохранённый не затираем и только возвращаем is_active
+    SQL = _upsert_users_sql(("username",), 1)
+    SQL_NO_USERNAME = _upsert_users_sql((), 1)
+
+    def __init__(self, pool: asyncpg.Pool, interval: float = 0.5, max_batch: int = 100) -> None:
+        self._pool = pool
+        self._interval = interval
+        self._max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._batch: list = []
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, tg_id: int, username: Optional[str]) -> None:
+        self._queue.put_nowait((tg_id, username))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            item = await self._queue.get()
+            # None в очереди - сигнал close(): дописываем набранное и выходим
+            stop = item is None
+            if not stop:
+                self._batch.append(item)
+                deadline = loop.time() + self._interval
+                while len(self._batch) < self._max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    self._batch.append(item)
+            batch, self._batch = self._batch, []
+            if batch:
+                await self._write(batch)
+
+    async def _write(self, batch: list) -> None:
+        # Одна строка на tg_id: последний username побеждает
+        rows = dict(batch)
+        named = [(uid, None, None, None, None, name) for uid, name in rows.items() if name]
+        unnamed = [(uid, None, None, None, None, None) for uid, name in rows.items() if not name]
         try:
-            logger.info("Upserting user %s: name=%s, gender=%s, age=%s, vk_id=%s, username=%s", 
-                       tg_id, name, gender, age, vk_id, username)
-            await conn.execute(
-                """
-                INSERT INTO users (tg_id, name, gender, age, vk_id, username)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                ON CONFLICT (tg_id) DO UPDATE
-                SET name = COALESCE(EXCLUDED.name, users.name),
-                    gender = COALESCE(EXCLUDED.gender, users.gender),
-                    age = COALESCE(EXCLUDED.age, users.age),
-                    vk_id = COALESCE(EXCLUDED.vk_id, users.vk_id),
-                    username = COALESCE(EXCLUDED.username, users.username);
-                """,
-                tg_id,
-                name,
-                gender,
-                age,
-                vk_id,
-                username,
-            )
-            logger.info("Successfully upserted user %s", tg_id)
+            for sql, group in ((self.SQL, named), (self.SQL_NO_USERNAME, unnamed)):
+                if group:
+                    await _run_prepared(self._pool, "executemany", sql, group)
         except Exception as e:
-            logger.error("Failed to upsert user %s: %s", tg_id, e)
+            logging.getLogger("TusaBot").warning("Batched upsert of %d users failed: %s", len(rows), e)
+
+    async def close(self) -> None:
+        """Остановить фоновую задачу и записать всё, что осталось в очереди.
+
+        Задача не отменяется, а получает сигнал в очереди и сама дописывает
+        текущую пачку - отмена посреди executemany потеряла бы её.
+        """
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+        batch, self._batch = self._batch, []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+        if batch:
+            await self._write(batch)
+
+
+VK_CHANNEL = "users_vk_changed"
+
+
+class VkIdListener:
+    """Держит кеш VK ID в актуальном состоянии через LISTEN на ``VK_CHANNEL``.
+
+    Триггер notify_vk_change шлёт "tg_id:vk_id" на каждое изменение vk_id,
+    кем бы оно ни было сделано; ``on_change`` получает (tg_id, vk_id или None).
+    После подписки загружается полный снимок (``load_user_vk_data``) и
+    отдаётся в ``on_snapshot``; уведомления, пришедшие пока снимок грузится,
+    копятся и применяются после него, чтобы снимок не затёр более новые.
+    Если соединение рвётся (перезапуск сервера, обрыв по простою), подписка
+    и снимок восстанавливаются на новом соединении.
+    Под подписку занимается одно соединение пула до вызова ``close``.
+    """
+
+    RETRY_DELAY = 5
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        on_change: Callable[[int, Optional[str]], None],
+        on_snapshot: Callable[[dict[int, str]], None],
+    ) -> None:
+        self._pool = pool
+        self._on_change = on_change
+        self._on_snapshot = on_snapshot
+        self._conn: Optional[asyncpg.Connection] = None
+        self._pending: Optional[list[tuple[int, Optional[str]]]] = None
+        self._resubscribe_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def _handle(self, conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        tg_id, _, vk_id = payload.partition(":")
+        try:
+            change = (int(tg_id), vk_id or None)
+        except ValueError as e:
+            logging.getLogger("TusaBot").warning("Bad %s notification %r: %s", channel, payload, e)
+            return
+        if self._pending is not None:
+            self._pending.append(change)
+        else:
+            self._on_change(*change)
+
+    def _on_terminated(self, conn: asyncpg.Connection) -> None:
+        # Пул сам освобождает умершее соединение - остаётся подписаться заново
+        if self._closed or self._conn is None:
+            return
+        self._conn = None
+        logging.getLogger("TusaBot").warning("VK id listener connection lost, resubscribing")
+        self._resubscribe_task = asyncio.create_task(self._resubscribe())
+
+    async def _subscribe(self) -> None:
+        conn = await self._pool.acquire()
+        self._pending = []
+        try:
+            await conn.add_listener(VK_CHANNEL, self._handle)
+            conn.add_termination_listener(self._on_terminated)
+            snapshot = await load_user_vk_data(conn)
+        except BaseException:
+            self._pending = None
+            if not conn.is_closed():
+                await self._detach(conn)
             raise
+        self._conn = conn
+        self._on_snapshot(snapshot)
+        pending, self._pending = self._pending, None
+        for change in pending:
+            self._on_change(*change)
 
+    async def _resubscribe(self) -> None:
+        logger = logging.getLogger("TusaBot")
+        while not self._closed:
+            try:
+                await self._subscribe()
+            except Exception as e:
+                logger.warning("Failed to resubscribe to VK id changes: %s", e)
+                await asyncio.sleep(self.RETRY_DELAY)
+            else:
+                logger.info("VK id listener resubscribed")
+                return
 
-async def set_vk_id(pool: asyncpg.Pool, tg_id: int, vk_id: str) -> None:
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE users SET vk_id=$2 WHERE tg_id=$1",
-            tg_id,
-            vk_id,
-        )
+    async def _detach(self, conn: asyncpg.Connection) -> None:
+        conn.remove_termination_listener(self._on_terminated)
+        await conn.remove_listener(VK_CHANNEL, self._handle)
+        await self._pool.release(conn)
 
+    async def start(self) -> None:
+        """Подписаться и загрузить снимок; ошибка подписки пробрасывается"""
+        if self._conn is None:
+            await self._subscribe()
 
-async def get_user(pool: asyncpg.Pool, tg_id: int) -> Optional[Dict[str, Any]]:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
-        return dict(row) if row else None
+    async def close(self) -> None:
+        """Снять подписку и вернуть соединение в пул"""
+        self._closed = True
+        if self._resubscribe_task is not None:
+            self._resubscribe_task.cancel()
+            try:
+                await self._resubscribe_task
+            except asyncio.CancelledError:
+                pass
+            self._resubscribe_task = None
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await self._detach(conn)
+
+
+# Столбцы, которые читают вызывающие; SELECT * тянул бы updated_at, недели
+# посещений и всё, что добавится в таблицу потом
+USER_SELECT_COLS = "tg_id, name, gender, age, vk_id, username, registered_at"
+
+GET_USER_SQL = f"SELECT {USER_SELECT_COLS} FROM users WHERE tg_id=$1"
+GET_USER_BY_USERNAME_SQL = f"SELECT {USER_SELECT_COLS} FROM users WHERE LOWER(username)=LOWER($1)"
+
+# Запросы, которые каждое соединение пула готовит заранее (см. PreparedConnection)
+HOT_STATEMENTS = (
+    _upsert_users_sql(USER_COLUMNS[1:], 1),
+    _upsert_users_sql(("vk_id",), 1),
+    UpsertQueue.SQL,
+    UpsertQueue.SQL_NO_USERNAME,
+    GET_USER_SQL,
+    GET_USER_BY_USERNAME_SQL,
+)
+
+
+# Record читается как словарь (get, [], keys) без копирования в dict;
+# кому нужна изменяемая копия - делает dict(row) сам
+async def get_user(pool: PoolOrConn, tg_id: int) -> Optional[asyncpg.Record]:
+    return await _run_prepared(pool, "fetchrow", GET_USER_SQL, tg_id)
 
 
-async def get_user_by_username(pool: asyncpg.Pool, username: str) -> Optional[Dict[str, Any]]:
+async def get_user_by_username(pool: PoolOrConn, username: str) -> Optional[asyncpg.Record]:
     """Поиск пользователя по Telegram username"""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE LOWER(username)=LOWER($1)", username)
-        return dict(row) if row else None
+    return await _run_prepared(pool, "fetchrow", GET_USER_BY_USERNAME_SQL, username)
 
 
 async def get_all_user_ids(pool: asyncpg.Pool) -> list[int]:
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT tg_id FROM users")
-        return [r[0] for r in rows]
+    rows = await pool.fetch("SELECT tg_id FROM users")
+    return [r[0] for r in rows]
+
+
+async def count_users(pool: asyncpg.Pool) -> int:
+    return await pool.fetchval("SELECT count(*) FROM users")
+
+
+async def get_first_users(pool: asyncpg.Pool, limit: int = 5) -> list[asyncpg.Record]:
+    """Первые ``limit`` пользователей по tg_id (для диагностики)"""
+    return await pool.fetch(f"SELECT {USER_SELECT_COLS} FROM users ORDER BY tg_id LIMIT $1", limit)
+
+
+async def get_active_user_ids(pool: asyncpg.Pool) -> list[int]:
+    """tg_id пользователей, не заблокировавших бота (им имеет смысл слать рассылки)"""
+    rows = await pool.fetch("SELECT tg_id FROM users WHERE is_active")
+    return [r[0] for r in rows]
+
+
+async def set_user_active(pool: asyncpg.Pool, tg_id: int, active: bool) -> None:
+    await pool.execute("UPDATE users SET is_active=$2 WHERE tg_id=$1", tg_id, active)
 
 
-async def load_user_vk_data(pool: asyncpg.Pool) -> dict[int, str]:
+async def load_user_vk_data(pool: PoolOrConn) -> dict[int, str]:
     """Загрузить VK ID всех пользователей для кеширования"""
+    rows = await pool.fetch("SELECT tg_id, vk_id FROM users WHERE vk_id IS NOT NULL")
+    return {row[0]: row[1] for row in rows}
+
+
+async def advance_missed_weeks(pool: asyncpg.Pool, week_key: str, threshold: int = 2) -> list[int]:
+    """Закрыть неделю week_key одним UPDATE: посетившим обнулить счётчик
+    пропусков, остальным увеличить. Возвращает tg_id тех, у кого пропусков
+    стало больше threshold.
+    """
+    rows = await pool.fetch(
+        """
+        WITH upd AS (
+            UPDATE users
+            SET missed_in_row = CASE WHEN $1 = ANY(attended_weeks) THEN 0 ELSE missed_in_row + 1 END
+            WHERE is_active AND NOT ($1 = ANY(attended_weeks) AND missed_in_row = 0)
+            RETURNING tg_id, missed_in_row
+        )
+        SELECT tg_id FROM upd WHERE missed_in_row > $2
+        """,
+        week_key,
+        threshold,
+    )
+    return [r[0] for r in rows]
+
+
+async def get_posters(pool: asyncpg.Pool) -> list[Dict[str, Any]]:
+    """Все активные афиши в порядке создания (последняя - актуальная)"""
+    rows = await pool.fetch(
+        "SELECT id, file_id, caption, ticket_url FROM posters WHERE is_active ORDER BY id"
+    )
+    return [dict(r) for r in rows]
+
+
+async def insert_poster(
+    pool: asyncpg.Pool,
+    file_id: str,
+    caption: Optional[str],
+    ticket_url: Optional[str],
+) -> int:
+    return await pool.fetchval(
+        "INSERT INTO posters (file_id, caption, ticket_url) VALUES ($1, $2, $3) RETURNING id",
+        file_id,
+        caption,
+        ticket_url,
+    )
+
+
+async def deactivate_poster(pool: asyncpg.Pool, poster_id: int) -> None:
+    """Скрыть афишу (строка остаётся в таблице для истории)"""
+    await pool.execute("UPDATE posters SET is_active=false WHERE id=$1", poster_id)
+
+
+async def set_poster_ticket_url(pool: asyncpg.Pool, poster_id: int, ticket_url: str) -> None:
+    await pool.execute("UPDATE posters SET ticket_url=$2 WHERE id=$1", poster_id, ticket_url)
+
+
+async def init_state_table(pool: asyncpg.Pool) -> None:
+    """Таблица для состояния бота (user_data/bot_data из PostgresPersistence)"""
+    await pool.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ptb_state (
+            scope TEXT NOT NULL,
+            key BIGINT NOT NULL,
+            value BYTEA NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (scope, key)
+        );
+        """
+    )
+
+
+async def load_state(pool: asyncpg.Pool, scope: str) -> dict[int, bytes]:
+    rows = await pool.fetch("SELECT key, value FROM ptb_state WHERE scope=$1", scope)
+    return {r[0]: r[1] for r in rows}
+
+
+async def save_state(pool: asyncpg.Pool, scope: str, items: list[tuple[int, bytes]]) -> None:
+    """Записать несколько ключей одного scope одним executemany"""
     async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT tg_id, vk_id FROM users WHERE vk_id IS NOT NULL")
-        return {row[0]: row[1] for row in rows}
+        await conn.executemany(
+            """
+            INSERT INTO ptb_state (scope, key, value) VALUES ($1, $2, $3)
+            ON CONFLICT (scope, key) DO UPDATE
+            SET value = EXCLUDED.value, updated_at = now();
+            """,
+            [(scope, key, value) for key, value in items],
+        )
+
+
+async def delete_state(pool: asyncpg.Pool, scope: str, key: int) -> None:
+    await pool.execute("DELETE FROM ptb_state WHERE scope=$1 AND key=$2", scope, key)
+
+
+# Агрегаты статистики пользователей (общие для админ-панели и экспорта)
+_USER_STATS_COLUMNS = """
+    COUNT(*) AS total_users,
+    COUNT(*) FILTER (WHERE vk_id IS NOT NULL) AS users_with_vk,
+    COUNT(*) FILTER (WHERE gender = 'male') AS male_users,
+    COUNT(*) FILTER (WHERE gender = 'female') AS female_users,
+    COUNT(*) FILTER (WHERE registered_at >= CURRENT_DATE) AS today_registrations
+"""
 
 
 async def get_user_stats(pool: asyncpg.Pool) -> dict:
     """Получить статистику пользователей"""
-    async with pool.acquire() as conn:
-        stats = await conn.fetchrow("""
-            SELECT 
-                COUNT(*) as total_users,
-                COUNT(vk_id) as users_with_vk,
-                COUNT(CASE WHEN gender = 'male' THEN 1 END) as male_users,
-                COUNT(CASE WHEN gender = 'female' THEN 1 END) as female_users,
-                COUNT(CASE WHEN registered_at >= CURRENT_DATE THEN 1 END) as today_registrations
-            FROM users
-        """)
-        return dict(stats) if stats else {}
+    stats = await pool.fetchrow(f"SELECT {_USER_STATS_COLUMNS} FROM users")
+    return dict(stats) if stats else {}
 
 
 async def export_users_to_excel(pool: asyncpg.Pool, filename: str = "users_export.xlsx") -> str:
-    """Экспорт всех пользователей в Excel файл"""
+    """Экспорт всех пользователей в Excel файл
+
+    Строки читаются курсором порциями и сразу пишутся в write-only книгу,
+    поэтому в памяти не держится ни вся выборка, ни все ячейки листа.
+    """
     try:
         from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
         from openpyxl.styles import Font, PatternFill, Alignment
         from datetime import datetime
         
-        async with pool.acquire() as conn:
-            users = await conn.fetch("""
-                SELECT 
-                    tg_id,
-                    name,
-                    gender,
-                    age,
-                    vk_id,
-                    registered_at,
-                    created_at
-                FROM users 
-                ORDER BY registered_at DESC
-            """)
-        
         # Создаем Excel файл
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Пользователи TusaBot"
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Пользователи TusaBot")
         
         # Заголовки
         headers = [
@@ -201,60 +662,80 @@ async def export_users_to_excel(pool: asyncpg.Pool, filename: str = "users_expor
         header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
         header_alignment = Alignment(horizontal="center", vertical="center")
         
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
+        def header_row(sheet, values):
+            row = []
+            for value in values:
+                cell = WriteOnlyCell(sheet, value=value)
+                cell.font = header_font
+                cell.fill = header_fill
+                cell.alignment = header_alignment
+                row.append(cell)
+            return row
+        
+        # В write-only режиме ширину колонок задают до записи строк, поэтому
+        # длины текстовых колонок берём агрегатом из БД, а не вторым проходом
+        # по листу. Тем же проходом по таблице считается статистика для
+        # второго листа. Остальные колонки фиксированной ширины.
+        summary = await pool.fetchrow(
+            f"""
+            SELECT {_USER_STATS_COLUMNS},
+                max(length(name)) AS name_len,
+                max(length(vk_id)) AS vk_len
+            FROM users
+            """
+        )
+        stats = dict(summary)
+        widths = [len(h) for h in headers]
+        widths[0] = max(widths[0], 14)
+        widths[1] = max(widths[1], len("Не указано"), summary['name_len'] or 0)
+        widths[2] = max(widths[2], len("Не указано"))
+        widths[3] = max(widths[3], len("Не указано"))
+        widths[4] = max(widths[4], len("Не привязан"), summary['vk_len'] or 0)
+        widths[5] = max(widths[5], len("01.01.2024 00:00"))
+        widths[6] = max(widths[6], len("01.01.2024 00:00"))
+        for letter, width in zip("ABCDEFG", widths):
+            ws.column_dimensions[letter].width = min(width + 2, 50)
+        ws.append(header_row(ws, headers))
         
         # Данные пользователей
-        for row_idx, user in enumerate(users, 2):
-            ws.cell(row=row_idx, column=1, value=user['tg_id'])
-            ws.cell(row=row_idx, column=2, value=user['name'] or "Не указано")
-            
-            # Пол на русском
-            gender_map = {"male": "Мужской", "female": "Женский"}
-            ws.cell(row=row_idx, column=3, value=gender_map.get(user['gender'], "Не указано"))
-            
-            # Возраст
-            age = user['age']
-            if age:
-                ws.cell(row=row_idx, column=4, value=f"{age} лет")
-            else:
-                ws.cell(row=row_idx, column=4, value="Не указано")
-            
-            ws.cell(row=row_idx, column=5, value=user['vk_id'] or "Не привязан")
-            
-            # Даты
-            if user['registered_at']:
-                ws.cell(row=row_idx, column=6, value=user['registered_at'].strftime("%d.%m.%Y %H:%M"))
-            else:
-                ws.cell(row=row_idx, column=6, value="Не указано")
-                
-            if user['created_at']:
-                ws.cell(row=row_idx, column=7, value=user['created_at'].strftime("%d.%m.%Y %H:%M"))
-            else:
-                ws.cell(row=row_idx, column=7, value="Не указано")
+        gender_map = {"male": "Мужской", "female": "Женский"}
         
-        # Автоподбор ширины колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
+        def fmt_date(value):
+            return value.strftime("%d.%m.%Y %H:%M") if value else "Не указано"
+        
+        async with pool.acquire() as conn:
+            # Курсоры asyncpg работают только внутри транзакции
+            async with conn.transaction():
+                async for user in conn.cursor(
+                    """
+                    SELECT 
+                        tg_id,
+                        name,
+                        gender,
+                        age,
+                        vk_id,
+                        registered_at,
+                        created_at
+                    FROM users 
+                    ORDER BY registered_at DESC
+                    """,
+                    prefetch=1000,
+                ):
+                    age = user['age']
+                    ws.append([
+                        user['tg_id'],
+                        user['name'] or "Не указано",
+                        gender_map.get(user['gender'], "Не указано"),
+                        f"{age} лет" if age else "Не указано",
+                        user['vk_id'] or "Не привязан",
+                        fmt_date(user['registered_at']),
+                        fmt_date(user['created_at']),
+                    ])
         
         # Добавляем лист со статистикой
         stats_ws = wb.create_sheet("Статистика")
-        stats = await get_user_stats(pool)
         
         stats_data = [
-            ["Показатель", "Значение"],
             ["Всего пользователей", stats.get('total_users', 0)],
             ["С привязанным VK", stats.get('users_with_vk', 0)],
             ["Мужчин", stats.get('male_users', 0)],
@@ -262,28 +743,12 @@ async def export_users_to_excel(pool: asyncpg.Pool, filename: str = "users_expor
             ["Зарегистрировано сегодня", stats.get('today_registrations', 0)],
             ["Дата экспорта", datetime.now().strftime("%d.%m.%Y %H:%M")]
         ]
-        
-        for row_idx, (label, value) in enumerate(stats_data, 1):
-            stats_ws.cell(row=row_idx, column=1, value=label)
-            stats_ws.cell(row=row_idx, column=2, value=value)
-            if row_idx == 1:  # Заголовок
-                stats_ws.cell(row=row_idx, column=1).font = header_font
-                stats_ws.cell(row=row_idx, column=2).font = header_font
-                stats_ws.cell(row=row_idx, column=1).fill = header_fill
-                stats_ws.cell(row=row_idx, column=2).fill = header_fill
-        
-        # Автоподбор ширины для статистики
-        for column in stats_ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = max_length + 2
-            stats_ws.column_dimensions[column_letter].width = adjusted_width
+        # Ширины считаем по уже собранным строкам - их всего несколько
+        for letter, column in zip("AB", zip(["Показатель", "Значение"], *stats_data)):
+            stats_ws.column_dimensions[letter].width = max(len(str(v)) for v in column) + 2
+        stats_ws.append(header_row(stats_ws, ["Показатель", "Значение"]))
+        for row in stats_data:
+            stats_ws.append(row)
         
         # Сохраняем файл
         wb.save(filename)
@@ -4,9 +4,10 @@
 import asyncio
 import os
 import pickle
+from itertools import islice
 from pathlib import Path
 from dotenv import load_dotenv
-from db import create_pool, get_all_user_ids, get_user
+from db import create_pool, count_users, get_first_users
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -16,14 +17,13 @@ async def check_database():
     print("🔍 Проверяем базу данных PostgreSQL...")
     try:
         pool = await create_pool()
-        user_ids = await get_all_user_ids(pool)
-        print(f"📊 Пользователей в БД: {len(user_ids)}")
+        total = await count_users(pool)
+        print(f"📊 Пользователей в БД: {total}")
         
-        if user_ids:
+        if total:
             print("👥 Пользователи в БД:")
-            for user_id in user_ids[:5]:  # Показываем первых 5
-                user_data = await get_user(pool, user_id)
-                print(f"  - {user_id}: {user_data}")
+            for user_data in await get_first_users(pool, 5):  # Показываем первых 5 одним запросом
+                print(f"  - {user_data['tg_id']}: {dict(user_data)}")
         else:
             print("❌ База данных пустая")
             
@@ -45,10 +45,11 @@ def check_persistence_file():
         if path.exists():
             print(f"📁 Найден файл: {path}")
             try:
+                # Размер берём с диска, а не через str(data) всего содержимого
+                print(f"📊 Размер файла: {path.stat().st_size} байт")
                 with open(path, 'rb') as f:
                     data = pickle.load(f)
                     
-                print(f"📊 Размер данных: {len(str(data))} символов")
                 print(f"🔑 Ключи в данных: {list(data.keys())}")
                 
                 # Проверяем известных пользователей
@@ -62,7 +63,7 @@ def check_persistence_file():
                 if 'user_data' in data:
                     user_data = data['user_data']
                     print(f"📝 Данных пользователей: {len(user_data)}")
-                    for user_id, udata in list(user_data.items())[:3]:
+                    for user_id, udata in islice(user_data.items(), 3):
                         print(f"  - Пользователь {user_id}:")
                         for key, value in udata.items():
                             print(f"    {key}: {value}")
@@ -4,14 +4,51 @@
 """
 import asyncio
 import pickle
+from collections import Counter
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from db import create_pool, upsert_user, DB_HOST, DB_PORT, DB_NAME, DB_USER
+from db import create_pool, USER_COLUMNS, USER_ONCONFLICT, DB_HOST, DB_PORT, DB_NAME, DB_USER
 
 # Загружаем переменные окружения из .env
 load_dotenv()
 
+STAGE_COLUMNS = list(USER_COLUMNS)
+
+STAGE_TABLE_SQL = """
+    CREATE TEMP TABLE users_stage (
+        tg_id BIGINT,
+        name TEXT,
+        gender TEXT,
+        age INTEGER,
+        vk_id TEXT,
+        username TEXT
+    ) ON COMMIT DROP;
+"""
+
+# Правило слияния строк с разным набором полей из db (USER_ONCONFLICT).
+# DISTINCT ON - один и тот же tg_id нельзя дважды обновить в одном INSERT ... ON CONFLICT
+MERGE_SQL = f"""
+    INSERT INTO users ({', '.join(USER_COLUMNS)})
+    SELECT DISTINCT ON (tg_id) {', '.join(USER_COLUMNS)}
+    FROM users_stage
+    ORDER BY tg_id
+    {USER_ONCONFLICT};
+"""
+
+def skip_reason(user_info: dict):
+    """Почему пользователя нельзя перенести (None - можно)"""
+    if not user_info.get("registered"):
+        return "не завершил регистрацию"
+    if not user_info.get("name"):
+        return "нет имени"
+    # Одна строка, нарушающая CHECK, откатила бы всю пачку - отсеиваем заранее
+    gender, age = user_info.get("gender"), user_info.get("age")
+    if gender not in (None, "male", "female") or (age is not None and not 14 <= age <= 100):
+        return "некорректные пол/возраст"
+    return None
+
+
 async def migrate_users():
     # Проверяем переменные окружения
     print("🔍 Проверка конфигурации БД...")
@@ -49,46 +86,41 @@ async def migrate_users():
         print(f"❌ Ошибка подключения к БД: {e}")
         return
     
-    # Переносим каждого пользователя
-    migrated = 0
-    skipped = 0
-    
+    # Собираем строки за один проход; пропуски считаем по причинам, а не печатаем по одному
+    rows = []
+    reasons = Counter()
     for tg_id, user_info in user_data.items():
+        reason = skip_reason(user_info)
+        if reason:
+            reasons[reason] += 1
+            continue
+        # Username не хранится в persistence, будет обновлен при следующем /start
+        rows.append((
+            int(tg_id),
+            user_info["name"],
+            user_info.get("gender"),
+            user_info.get("age"),
+            user_info.get("vk_id"),
+            None,
+        ))
+    skipped = sum(reasons.values())
+    for reason, count in reasons.items():
+        print(f"⏭️  Пропущено ({reason}): {count}")
+    
+    # Сохраняем в БД одной пачкой: COPY во временную таблицу и один INSERT ... ON CONFLICT
+    migrated = 0
+    if rows:
         try:
-            # Проверяем что есть необходимые данные
-            if not user_info.get("registered"):
-                print(f"⏭️  Пропускаем {tg_id} - не завершил регистрацию")
-                skipped += 1
-                continue
-            
-            name = user_info.get("name")
-            gender = user_info.get("gender")
-            age = user_info.get("age")
-            vk_id = user_info.get("vk_id")
-            username = None  # Username не хранится в persistence, будет обновлен при следующем /start
-            
-            if not name:
-                print(f"⏭️  Пропускаем {tg_id} - нет имени")
-                skipped += 1
-                continue
-            
-            # Сохраняем в БД
-            await upsert_user(
-                pool=pool,
-                tg_id=tg_id,
-                name=name,
-                gender=gender,
-                age=age,
-                vk_id=vk_id,
-                username=username
-            )
-            
-            migrated += 1
-            print(f"✅ {migrated}. Перенесен: {name} (ID: {tg_id})")
-            
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(STAGE_TABLE_SQL)
+                    await conn.copy_records_to_table("users_stage", records=rows, columns=STAGE_COLUMNS)
+                    await conn.execute(MERGE_SQL)
+            migrated = len(rows)
         except Exception as e:
-            print(f"❌ Ошибка при переносе {tg_id}: {e}")
-            skipped += 1
+            print(f"❌ Ошибка при переносе: {e}")
+            skipped += len(rows)
+    print(f"✅ Перенесено одной пачкой: {migrated}")
     
     await pool.close()
     
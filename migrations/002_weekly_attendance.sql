@@ -0,0 +1,6 @@
+-- Weekly attendance tracking for re-engagement messages
+-- (previously kept in pickled user_data)
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS attended_weeks TEXT[] NOT NULL DEFAULT '{}',
+    ADD COLUMN IF NOT EXISTS missed_in_row INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,4 @@
+-- Users who blocked the bot are skipped by broadcasts until they /start again
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT true;
@@ -0,0 +1,10 @@
+-- Bot state (PTB user_data/bot_data) moves from the pickle file to Postgres.
+-- One row per user / one row for bot_data, rewritten only when it changes.
+
+CREATE TABLE IF NOT EXISTS ptb_state (
+    scope TEXT NOT NULL,
+    key BIGINT NOT NULL,
+    value BYTEA NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT now(),
+    PRIMARY KEY (scope, key)
+);
@@ -0,0 +1,3 @@
+-- get_user_by_username filters on LOWER(username); index the expression itself
+
+CREATE INDEX IF NOT EXISTS users_username_lower_idx ON users (LOWER(username));
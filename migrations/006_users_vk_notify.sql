@@ -0,0 +1,19 @@
+-- Notify the bot when a user's vk_id changes so its in-memory VK cache stays current
+
+CREATE OR REPLACE FUNCTION notify_vk_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF (TG_OP = 'INSERT' AND NEW.vk_id IS NOT NULL)
+       OR (TG_OP = 'UPDATE' AND NEW.vk_id IS DISTINCT FROM OLD.vk_id) THEN
+        PERFORM pg_notify('users_vk_changed', NEW.tg_id::text || ':' || COALESCE(NEW.vk_id, ''));
+    END IF;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS users_vk_changed ON users;
+
+CREATE TRIGGER users_vk_changed
+    AFTER INSERT OR UPDATE OF vk_id ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_vk_change();
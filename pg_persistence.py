@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import pickle
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import asyncpg
+import orjson
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import init_state_table, load_state, save_state, delete_state
+
+logger = logging.getLogger("TusaBot")
+
+USER_SCOPE = "user"
+BOT_SCOPE = "bot"
+BOT_KEY = 0
+
+
+def _to_json(obj: Any) -> Any:
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class PostgresPersistence(BasePersistence):
+    """Хранит user_data и bot_data в таблице ptb_state вместо pickle-файла.
+
+    PicklePersistence на каждом сохранении переписывает весь файл целиком;
+    здесь пишутся только изменившиеся пользователи (их PTB передаёт сам)
+    и bot_data, если он отличается от последнего записанного.
+    chat_data, callback_data и состояния диалогов бот не использует.
+
+    Пул соединений создаётся при первом обращении через ``pool_factory``:
+    PTB читает состояние раньше post_init, поэтому бот берёт пул отсюда
+    (см. ``get_pool``), а не создаёт второй.
+
+    Значения пишутся в JSON через orjson (dataclass-ы он сериализует сам,
+    множества - списками). ``user_data_loader``/``bot_data_loader`` собирают
+    из прочитанного JSON объекты, которые ожидает бот.
+    """
+
+    def __init__(
+        self,
+        pool_factory: Callable[[], Awaitable[asyncpg.Pool]],
+        legacy_file: Optional[Path] = None,
+        update_interval: float = 60,
+        user_data_loader: Callable[[dict], dict] = dict,
+        bot_data_loader: Callable[[dict], dict] = dict,
+    ) -> None:
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._pool_factory = pool_factory
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+        self._legacy_file = legacy_file
+        self._legacy: Optional[Dict[str, Any]] = None
+        self._bot_data_blob: Optional[bytes] = None
+        self._user_data_loader = user_data_loader
+        self._bot_data_loader = bot_data_loader
+
+    async def get_pool(self) -> asyncpg.Pool:
+        if self._pool is not None:
+            return self._pool
+        async with self._pool_lock:
+            if self._pool is None:
+                pool = await self._pool_factory()
+                await init_state_table(pool)
+                self._pool = pool
+        return self._pool
+
+    @staticmethod
+    def _dumps(data: Any) -> bytes:
+        return orjson.dumps(data, default=_to_json)
+
+    @staticmethod
+    def _loads(blob: bytes) -> Any:
+        # Строки, записанные до перехода на JSON, остались в pickle
+        if blob[:1] != b"{":
+            return pickle.loads(blob)
+        return orjson.loads(blob)
+
+    def _load_legacy(self) -> Dict[str, Any]:
+        """Содержимое старого pickle-файла (для переноса при первом запуске)"""
+        if self._legacy is None:
+            self._legacy = {}
+            if self._legacy_file and self._legacy_file.exists():
+                try:
+                    with self._legacy_file.open("rb") as f:
+                        self._legacy = pickle.load(f)
+                except Exception as e:
+                    logger.warning("Failed to read legacy persistence file %s: %s", self._legacy_file, e)
+        return self._legacy
+
+    async def _load_scope(self, scope: str) -> Optional[dict]:
+        try:
+            pool = await self.get_pool()
+            return await load_state(pool, scope)
+        except Exception as e:
+            logger.error("Failed to load %s state from DB: %s", scope, e)
+            return None
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        rows = await self._load_scope(USER_SCOPE)
+        if rows is None:
+            return {}
+        if not rows:
+            legacy = self._load_legacy().get("user_data") or {}
+            if legacy:
+                try:
+                    await save_state(self._pool, USER_SCOPE, [(uid, self._dumps(d)) for uid, d in legacy.items()])
+                    logger.info("Migrated user_data of %d users from pickle to DB", len(legacy))
+                except Exception as e:
+                    logger.warning("Failed to migrate user_data to DB: %s", e)
+            return dict(legacy)
+        user_data = {}
+        for uid, blob in rows.items():
+            try:
+                user_data[uid] = self._user_data_loader(self._loads(blob))
+            except Exception as e:
+                logger.warning("Skipping unreadable user_data of %s: %s", uid, e)
+        return user_data
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        rows = await self._load_scope(BOT_SCOPE)
+        if rows is None:
+            return {}
+        blob = rows.get(BOT_KEY)
+        if blob is None:
+            data = self._load_legacy().get("bot_data") or {}
+            if data:
+                await self.update_bot_data(data)
+            return data
+        try:
+            data = self._bot_data_loader(self._loads(blob))
+        except Exception as e:
+            logger.warning("Skipping unreadable bot_data: %s", e)
+            return {}
+        self._bot_data_blob = blob
+        return data
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        try:
+            await save_state(await self.get_pool(), USER_SCOPE, [(user_id, self._dumps(data))])
+        except Exception as e:
+            logger.warning("Failed to persist user_data of %s: %s", user_id, e)
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        try:
+            blob = self._dumps(data)
+        except Exception as e:
+            logger.warning("bot_data is not serializable: %s", e)
+            return
+        if blob == self._bot_data_blob:
+            return
+        try:
+            await save_state(await self.get_pool(), BOT_SCOPE, [(BOT_KEY, blob)])
+            self._bot_data_blob = blob
+        except Exception as e:
+            logger.warning("Failed to persist bot_data: %s", e)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        try:
+            await delete_state(await self.get_pool(), USER_SCOPE, user_id)
+        except Exception as e:
+            logger.warning("Failed to drop user_data of %s: %s", user_id, e)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # Все изменения уже записаны в update_*; пул закрывает сам бот
+        pass
+
+    # chat_data, callback_data и диалоги не хранятся (см. store_data)
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        pass
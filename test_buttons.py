@@ -51,9 +51,9 @@ async def test_buttons():
             print("❌ VK выключен - кнопки VK не будет")
             
         print("Проверяем переменные VK:")
-        from bot import VK_TOKEN, VK_GROUP_DOMAIN
-        print(f"VK_TOKEN: {'✅ установлен' if VK_TOKEN else '❌ не установлен'}")
-        print(f"VK_GROUP_DOMAIN: {VK_GROUP_DOMAIN}")
+        from bot import CONFIG
+        print(f"VK_TOKEN: {'✅ установлен' if CONFIG.vk_token else '❌ не установлен'}")
+        print(f"VK_GROUP_DOMAIN: {CONFIG.vk_group_domain}")
         
     except Exception as e:
         print(f"💥 Ошибка: {e}")
@@ -9,13 +9,13 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Импортируем функции из бота
-from bot import is_user_subscribed_vk, VK_ENABLED, VK_TOKEN, VK_GROUP_DOMAIN
+from bot import is_user_subscribed_vk, VK_ENABLED, CONFIG
 
 async def test_vk_functions():
     print("🔍 Тестирование VK функций...")
     print(f"VK_ENABLED: {VK_ENABLED}")
-    print(f"VK_TOKEN: {VK_TOKEN[:20]}..." if VK_TOKEN else "VK_TOKEN: None")
-    print(f"VK_GROUP_DOMAIN: {VK_GROUP_DOMAIN}")
+    print(f"VK_TOKEN: {CONFIG.vk_token[:20]}..." if CONFIG.vk_token else "VK_TOKEN: None")
+    print(f"VK_GROUP_DOMAIN: {CONFIG.vk_group_domain}")
     print()
     
     if not VK_ENABLED: